@@ -0,0 +1,184 @@
+import os
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock, get_ident
+from typing import Any, Callable, Hashable, Optional
+
+from loguru import logger
+
+
+@dataclass
+class CacheStats:
+    hits: int
+    misses: int
+    evictions: int
+    numEntries: int
+    sizeBytes: int
+    maxSizeBytes: int
+
+
+class SizeBoundedLRUCache:
+    """Thread safe LRU cache which evicts the least recently used entries once the total size of the values exceeds the budget."""
+
+    def __init__(self, name: str, max_size_bytes: int, get_size: Callable[[Any], int]):
+        self.name = name
+        self.max_size_bytes = max_size_bytes
+        self.get_size = get_size
+
+        self.entries: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self.lock:
+            return key in self.entries
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def put(self, key: Hashable, value: Any):
+        size = self.get_size(value)
+        if size > self.max_size_bytes:
+            logger.info(f"Not caching {key} in {self.name} cache, {size} bytes is above the {self.max_size_bytes} bytes budget")
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.size_bytes -= self.entries.pop(key)[1]
+
+            self.entries[key] = (value, size)
+            self.size_bytes += size
+
+            while self.size_bytes > self.max_size_bytes:
+                evicted_key, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size_bytes -= evicted_size
+                self.evictions += 1
+                logger.info(f"Evicted {evicted_key} from {self.name} cache")
+
+    def get_stats(self) -> CacheStats:
+        with self.lock:
+            return CacheStats(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                numEntries=len(self.entries),
+                sizeBytes=self.size_bytes,
+                maxSizeBytes=self.max_size_bytes
+            )
+
+
+class DiskLRUCache:
+    """
+    Cache of byte values stored as one file per key in a directory, which evicts the least recently used files once their
+    total size exceeds the budget. Reads bump the modification time, so the cache survives restarts with its recency order.
+    """
+
+    def __init__(self, name: str, directory: str, max_size_bytes: int):
+        self.name = name
+        self.directory = directory
+        self.max_size_bytes = max_size_bytes
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = Lock()
+
+        os.makedirs(self.directory, exist_ok=True)
+        # Temp files are either being written by another process sharing the directory or left over from a crashed write,
+        # neither of which are entries
+        self.size_bytes = sum(
+            entry.stat().st_size for entry in os.scandir(self.directory) if entry.is_file() and not entry.name.endswith(".tmp")
+        )
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self.get_path(key)
+        try:
+            with open(path, "rb") as f:
+                value = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return None
+
+        with self.lock:
+            self.hits += 1
+        return value
+
+    def put(self, key: str, value: bytes):
+        if len(value) > self.max_size_bytes:
+            logger.info(f"Not caching {key} in {self.name} cache, {len(value)} bytes is above the {self.max_size_bytes} bytes budget")
+            return
+
+        path = self.get_path(key)
+        temp_path = f"{path}.{os.getpid()}.{get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(value)
+
+        with self.lock:
+            if os.path.exists(path):
+                self.size_bytes -= os.path.getsize(path)
+            os.replace(temp_path, path)
+            self.size_bytes += len(value)
+
+            if self.size_bytes > self.max_size_bytes:
+                self.evict()
+
+    def evict(self):
+        entries = sorted(
+            [entry for entry in os.scandir(self.directory) if entry.is_file() and not entry.name.endswith(".tmp")],
+            key=lambda entry: entry.stat().st_mtime
+        )
+        for entry in entries:
+            if self.size_bytes <= self.max_size_bytes:
+                break
+
+            size = entry.stat().st_size
+            os.remove(entry.path)
+            self.size_bytes -= size
+            self.evictions += 1
+            logger.info(f"Evicted {entry.name} from {self.name} cache")
+
+    def get_stats(self) -> CacheStats:
+        with self.lock:
+            return CacheStats(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                numEntries=len([name for name in os.listdir(self.directory) if not name.endswith(".tmp")]),
+                sizeBytes=self.size_bytes,
+                maxSizeBytes=self.max_size_bytes
+            )
+
+
+class TieredCache:
+    """Byte value cache with a memory tier in front of a disk tier, values read from disk are promoted to memory."""
+
+    def __init__(self, memory_cache: SizeBoundedLRUCache, disk_cache: DiskLRUCache):
+        self.memory_cache = memory_cache
+        self.disk_cache = disk_cache
+
+    def get(self, key: str) -> Optional[bytes]:
+        value = self.memory_cache.get(key)
+        if value is None:
+            value = self.disk_cache.get(key)
+            if value is not None:
+                self.memory_cache.put(key, value)
+        return value
+
+    def put(self, key: str, value: bytes):
+        self.memory_cache.put(key, value)
+        self.disk_cache.put(key, value)
@@ -1,2 +1,12 @@
 class EmptyDataFrameError(Exception):
     pass
+
+
+class JobCancelledError(Exception):
+    pass
+
+
+class UploadOffsetMismatchError(Exception):
+    def __init__(self, size: int):
+        super().__init__(f"Chunk offset does not match the upload size {size}")
+        self.size = size
@@ -1,7 +1,65 @@
+import zlib
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+import polars as pl
+import pyarrow as pa
 from orjson import orjson
+from werkzeug.datastructures import Accept, MIMEAccept
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ARROW_STREAM_MIMETYPE = "application/vnd.apache.arrow.stream"
 
 
 def build_error_response(error: str) -> str:
     return orjson.dumps({
         'error': error
     })
+
+
+def negotiate_content_encoding(accept_encodings: Accept) -> Optional[str]:
+    """Pick zstd if the optional zstandard package is installed and the client accepts it, otherwise gzip if accepted."""
+    if zstandard is not None and accept_encodings["zstd"] > 0:
+        return "zstd"
+    if accept_encodings["gzip"] > 0:
+        return "gzip"
+    return None
+
+
+def get_encoded_etag(etag: str, content_encoding: Optional[str]) -> str:
+    """The ETag of the representation with the content encoding, compressed bodies differ byte by byte from the identity one."""
+    return etag if content_encoding is None else f"{etag}-{content_encoding}"
+
+
+def compress_chunks(chunks: Iterable[bytes], content_encoding: Optional[str]) -> Iterator[bytes]:
+    if content_encoding is None:
+        yield from chunks
+        return
+
+    compressor = zstandard.ZstdCompressor().compressobj() if content_encoding == "zstd" else zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        compressed_chunk = compressor.compress(chunk)
+        if len(compressed_chunk) > 0:
+            yield compressed_chunk
+    yield compressor.flush()
+
+
+def accepts_arrow_stream(accept_mimetypes: MIMEAccept) -> bool:
+    """Only clients asking for Arrow explicitly get it, a wildcard accept keeps getting json."""
+    return any(mimetype == ARROW_STREAM_MIMETYPE and quality > 0 for mimetype, quality in accept_mimetypes)
+
+
+def iter_arrow_streams(tables: Iterable[Tuple[pl.DataFrame, Dict[str, str]]], batch_size: int) -> Iterator[bytes]:
+    """
+    Write every frame as its own Arrow IPC stream of record batches, with the metadata attached to its schema. The streams
+    are concatenated, a client reads them one after the other until the end of the response.
+    """
+    for df, metadata in tables:
+        table = df.to_arrow().replace_schema_metadata(metadata)
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table, max_chunksize=batch_size)
+        yield sink.getvalue().to_pybytes()
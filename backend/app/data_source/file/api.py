@@ -3,6 +3,7 @@ from flask_appbuilder.api import BaseApi, expose
 from loguru import logger
 from orjson import orjson
 
+from app.common.errors import UploadOffsetMismatchError
 from app.common.request_utils import build_error_response
 from app.data_source.file.file_source import FileSource
 from app.data_source.file.file_upload_service import FileUploadService
@@ -11,6 +12,10 @@ from app.data_source.file.file_upload_service import FileUploadService
 class FileSourceApi(BaseApi):
     resource_name = 'source/file'
 
+    @staticmethod
+    def build_schema_response(md5: str):
+        return FileSource(md5).load_schema_json(), 200
+
     @expose('/schema', methods=['POST'])
     def load_schema(self):
         logger.info("Loading file from request")
@@ -22,16 +27,55 @@ class FileSourceApi(BaseApi):
 
         try:
             logger.info("Saving file to disk")
-            file_data = file.read()
-            output_dir = "/tmp/dsensei"
-
-            file_processor = FileUploadService()
-            md5 = file_processor.save_file_with_md5(file_data, output_dir)
-
-            schema = FileSource(md5).load_schema()
-            return orjson.dumps(schema, option=orjson.OPT_NON_STR_KEYS), 200
+            md5 = FileUploadService.save_stream_with_md5(file.stream, FileSource.temp_file_path)
+            return self.build_schema_response(md5)
         except FileExistsError as e:
             return build_error_response(str(e)), 409
         except Exception as e:
             logger.exception(e)
             return build_error_response(str(e)), 500
+
+    @expose('/upload', methods=['POST'])
+    def create_upload(self):
+        """Start a chunked upload for files too large to be sent in one request."""
+        return orjson.dumps({"uploadId": FileUploadService.create_upload(FileSource.temp_file_path), "size": 0}), 201
+
+    @expose('/upload/<upload_id>', methods=['GET'])
+    def get_upload(self, upload_id: str):
+        """The number of bytes received so far, to resume an interrupted upload from."""
+        try:
+            return orjson.dumps({"uploadId": upload_id, "size": FileUploadService.get_upload_size(FileSource.temp_file_path, upload_id)})
+        except (ValueError, FileNotFoundError):
+            return build_error_response("Upload not found"), 404
+
+    @expose('/upload/<upload_id>', methods=['PUT'])
+    def append_to_upload(self, upload_id: str):
+        """Append the request body to the upload, the offset query parameter has to be the number of bytes received so far."""
+        offset = request.args.get('offset', type=int)
+        if offset is None:
+            return build_error_response("Missing offset"), 400
+
+        try:
+            size = FileUploadService.append_to_upload(request.stream, FileSource.temp_file_path, upload_id, offset)
+            return orjson.dumps({"uploadId": upload_id, "size": size})
+        except (ValueError, FileNotFoundError):
+            return build_error_response("Upload not found"), 404
+        except UploadOffsetMismatchError as e:
+            return orjson.dumps({"error": str(e), "size": e.size}), 409
+        except Exception as e:
+            logger.exception(e)
+            return build_error_response(str(e)), 500
+
+    @expose('/upload/<upload_id>/complete', methods=['POST'])
+    def complete_upload(self, upload_id: str):
+        """Finish the upload and load the schema of the file, like a single request upload."""
+        try:
+            md5 = FileUploadService.complete_upload(FileSource.temp_file_path, upload_id)
+        except (ValueError, FileNotFoundError):
+            return build_error_response("Upload not found"), 404
+
+        try:
+            return self.build_schema_response(md5)
+        except Exception as e:
+            logger.exception(e)
+            return build_error_response(str(e)), 500
@@ -1,9 +1,14 @@
+import os
+import threading
+
 import polars as pl
 from loguru import logger
+from orjson import orjson
 
 from app import app
 from app.data_source.models import Field, DateField, FileSchema
-from app.insight.services.utils import load_df_from_csv
+from app.insight.services.metrics import flatten
+from app.insight.services.utils import load_df_from_file
 from config import ConfigKey
 
 
@@ -25,33 +30,76 @@ class FileSource:
         "Boolean": "BOOLEAN"
     }
     temp_file_path = app.config[ConfigKey.TEMP_FILE_PATH.name]
+    # Bump when the profile changes, so that the profiles persisted before are not served anymore
+    profile_version = 2
+    max_num_values = 500
+    values_sample_rows = 100000
 
     def __init__(self, file_name):
         self.file_name = file_name
 
+    def get_profile_path(self) -> str:
+        return f"{self.temp_file_path}/{self.file_name}.schema.v{self.profile_version}.json"
+
+    def load_schema_json(self) -> bytes:
+        """The serialized schema, profiled once per file and persisted next to it so that re-opening the file is instant."""
+        profile_path = self.get_profile_path()
+        if os.path.exists(profile_path):
+            with open(profile_path, "rb") as f:
+                return f.read()
+
+        schema_json = orjson.dumps(self.load_schema(), option=orjson.OPT_NON_STR_KEYS)
+        temp_profile_path = f"{profile_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_profile_path, "wb") as f:
+            f.write(schema_json)
+        os.replace(temp_profile_path, profile_path)
+        return schema_json
+
     def load_schema(self) -> FileSchema:
         logger.info("Loading file")
-        df = load_df_from_csv(f"{self.temp_file_path}/{self.file_name}")
+        df = load_df_from_file(f"{self.temp_file_path}/{self.file_name}")
+        date_columns = [
+            column for column, data_type in zip(df.columns, df.dtypes) if data_type == pl.Date or isinstance(data_type, pl.Datetime)
+        ]
 
-        logger.info("Calculating distinct values")
-        column_to_num_distinct_values = df.select(
-            [pl.col(column).n_unique() for column in df.columns]
+        # Profile all the columns in a single query over the frame. Large files get HyperLogLog based distinct counts, and the
+        # distinct values are taken from the first rows, only columns with fewer distinct values there are scanned in full.
+        logger.info("Profiling columns")
+        approximate_distinct = df.height >= app.config[ConfigKey.SCHEMA_APPROX_DISTINCT_MIN_ROWS.name]
+        profile = df.select(
+            [
+                (pl.col(column).approx_n_unique() if approximate_distinct else pl.col(column).n_unique()).alias(f"distinct:{column}")
+                for column in df.columns
+            ] + [
+                pl.col(column).head(self.values_sample_rows).unique().limit(self.max_num_values).cast(pl.Utf8).implode().alias(f"values:{column}")
+                for column in df.columns
+            ] + flatten([
+                [
+                    pl.col(column).cast(pl.Date).min().alias(f"min:{column}"),
+                    pl.col(column).cast(pl.Date).max().alias(f"max:{column}"),
+                    pl.col(column).cast(pl.Date).drop_nulls().cast(pl.Utf8).value_counts().implode().alias(f"rows_by_date:{column}")
+                ]
+                for column in date_columns
+            ]) + [
+                pl.col(df.columns[0]).count().alias("count")
+            ]
         ).row(0, named=True)
 
-        column_values_df = pl.concat(
-            [df.lazy().select(pl.col(column).unique().limit(500).cast(pl.Utf8).alias("values")).with_columns(pl.lit(column).alias("column"))
-             for column, num_distinct_values in column_to_num_distinct_values.items()]) \
-            .groupby("column").agg(pl.col("values").explode()).collect()
-        column_to_values = {row['column']: row['values'] for row in column_values_df.rows(named=True)}
-
-        logger.info("Calculating total rows")
-        count = df.select(pl.col(df.columns[0]).count()).row(0)[0]
+        incomplete_columns = [
+            column for column in df.columns if df.height > self.values_sample_rows and len(profile[f"values:{column}"]) < self.max_num_values
+        ]
+        if len(incomplete_columns) > 0:
+            profile.update(df.select([
+                pl.col(column).unique().limit(self.max_num_values).cast(pl.Utf8).implode().alias(f"values:{column}")
+                for column in incomplete_columns
+            ]).row(0, named=True))
 
         logger.info("Building fields info")
         fields = []
         for column, data_type in zip(df.columns, df.dtypes):
             data_type = self.data_type_map["Datetime" if isinstance(data_type, pl.Datetime) else str(data_type)]
-            num_distinct_values = column_to_num_distinct_values[column]
+            num_distinct_values = profile[f"distinct:{column}"]
+            values = profile[f"values:{column}"]
 
             if data_type != "DATE":
                 fields.append(Field(
@@ -60,31 +108,24 @@ class FileSource:
                     type=data_type,
                     mode="NULLABLE",
                     numDistinctValues=num_distinct_values,
-                    values=column_to_values[column]
+                    values=values
                 ))
             else:
-                df = df.with_columns(pl.col(column).cast(pl.Date))
-                min_date, max_date = df.select([
-                    pl.col(column).min().alias("min"),
-                    pl.col(column).min().alias("max"),
-                ]).row(0)
-                num_rows_by_date_df = df.groupby(pl.col(column).cast(pl.Utf8)).agg(pl.count(column).alias("count"))
-
                 fields.append(DateField(
                     column,
                     description="",
                     type=data_type,
                     mode="NULLABLE",
                     numDistinctValues=num_distinct_values,
-                    minDate=min_date,
-                    maxDate=max_date,
-                    numRowsByDate={row[column]: row["count"] for row in num_rows_by_date_df.rows(named=True) if row[column] is not None},
-                    values=column_to_values[column]
+                    minDate=profile[f"min:{column}"],
+                    maxDate=profile[f"max:{column}"],
+                    numRowsByDate={row[column]: row["counts"] for row in profile[f"rows_by_date:{column}"]},
+                    values=values
                 ))
         return FileSchema(
             name=self.file_name,
-            countRows=count,
+            countRows=profile["count"],
             description=None,
             fields=fields,
-            previewData=df.limit(10).rows(named=True)
+            previewData=df.limit(10).with_columns([pl.col(column).cast(pl.Date) for column in date_columns]).rows(named=True)
         )
@@ -1,10 +1,24 @@
 import hashlib
 import os
+import uuid
+from threading import Lock, get_ident
+from typing import BinaryIO, Dict, Tuple
 
 from loguru import logger
 
+from app.common.errors import UploadOffsetMismatchError
+
+# Size of the chunks an upload is read, hashed and written in, so that the file never has to be held in memory
+CHUNK_SIZE = 1024 * 1024
+
 
 class FileUploadService:
+    # The md5 state of the ongoing chunked uploads along with the number of bytes hashed, by upload id. The state does not
+    # survive a restart, the upload is hashed from disk when it is completed then.
+    upload_hashes: Dict[str, Tuple[int, "hashlib._Hash"]] = {}
+    upload_locks: Dict[str, Lock] = {}
+    lock = Lock()
+
     @staticmethod
     def calculate_md5(file_data):
         """Calculate the MD5 hash of file data."""
@@ -13,26 +27,122 @@ class FileUploadService:
         return md5_hash.hexdigest()
 
     @staticmethod
-    def save_file_with_md5(file_data, output_dir):
-        """Save the file data to the specified directory with the given filename."""
-        md5_hash = FileUploadService.calculate_md5(file_data)
-        filename_with_md5 = f"{md5_hash}"  # You can change the file extension if needed
+    def calculate_file_md5(path: str) -> str:
+        md5_hash = hashlib.md5()
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+                md5_hash.update(chunk)
+        return md5_hash.hexdigest()
 
+    @staticmethod
+    def ensure_directory(output_dir: str):
         if not os.path.exists(output_dir):
             try:
-                os.makedirs(output_dir)
+                os.makedirs(output_dir, exist_ok=True)
                 logger.info(f"Directory '{output_dir}' created successfully.")
             except Exception as e:
                 logger.exception(f"Error creating directory: {e}")
 
-        output_path = os.path.join(output_dir, filename_with_md5)
-
-        # Make sure the destination path does not already exist
+    @staticmethod
+    def move_to_md5_path(temp_path: str, md5_hash: str, output_dir: str) -> str:
+        """Atomically move the file to its md5 name, or drop it if the same file was uploaded before."""
+        output_path = os.path.join(output_dir, md5_hash)
         if os.path.exists(output_path):
-            return md5_hash
+            os.remove(temp_path)
+        else:
+            os.replace(temp_path, output_path)
+        return md5_hash
 
-        # Save the file data to the specified directory with the new name
-        with open(output_path, "wb") as file:
-            file.write(file_data)
+    @staticmethod
+    def save_stream_with_md5(stream: BinaryIO, output_dir):
+        """Write the stream to a temporary file chunk by chunk while hashing it, then move it to its md5 name."""
+        FileUploadService.ensure_directory(output_dir)
 
-        return md5_hash
+        md5_hash = hashlib.md5()
+        temp_path = os.path.join(output_dir, f"upload.{os.getpid()}.{get_ident()}.tmp")
+        try:
+            with open(temp_path, "wb") as file:
+                for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+                    md5_hash.update(chunk)
+                    file.write(chunk)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+        return FileUploadService.move_to_md5_path(temp_path, md5_hash.hexdigest(), output_dir)
+
+    @staticmethod
+    def get_upload_path(output_dir: str, upload_id: str) -> str:
+        # Only accept ids generated by create_upload, which can not point outside of the uploads directory
+        return os.path.join(output_dir, "uploads", f"{uuid.UUID(upload_id).hex}.part")
+
+    @staticmethod
+    def get_upload_lock(upload_id: str) -> Lock:
+        with FileUploadService.lock:
+            return FileUploadService.upload_locks.setdefault(upload_id, Lock())
+
+    @staticmethod
+    def create_upload(output_dir: str) -> str:
+        """Start a chunked upload, returning its id."""
+        upload_id = uuid.uuid4().hex
+        FileUploadService.ensure_directory(os.path.join(output_dir, "uploads"))
+        open(FileUploadService.get_upload_path(output_dir, upload_id), "wb").close()
+        with FileUploadService.lock:
+            FileUploadService.upload_hashes[upload_id] = (0, hashlib.md5())
+        return upload_id
+
+    @staticmethod
+    def get_upload_size(output_dir: str, upload_id: str) -> int:
+        """The number of bytes received so far, which is the offset the next chunk has to be sent at."""
+        return os.path.getsize(FileUploadService.get_upload_path(output_dir, upload_id))
+
+    @staticmethod
+    def append_to_upload(stream: BinaryIO, output_dir: str, upload_id: str, offset: int) -> int:
+        """
+        Append the chunk in the stream to the upload if it starts where the upload ends, returning the new size of the upload.
+        A chunk sent again after a lost response is rejected with the size to resume from.
+        """
+        path = FileUploadService.get_upload_path(output_dir, upload_id)
+        with FileUploadService.get_upload_lock(upload_id):
+            size = os.path.getsize(path)
+            if offset != size:
+                raise UploadOffsetMismatchError(size)
+
+            with FileUploadService.lock:
+                hashed_size, md5_hash = FileUploadService.upload_hashes.get(upload_id, (None, None))
+            if hashed_size != size:
+                md5_hash = None
+
+            with open(path, "ab") as file:
+                try:
+                    for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+                        if md5_hash is not None:
+                            md5_hash.update(chunk)
+                        file.write(chunk)
+                except BaseException:
+                    # Drop the partial chunk so that the upload can be resumed from the previous offset
+                    file.truncate(size)
+                    with FileUploadService.lock:
+                        FileUploadService.upload_hashes.pop(upload_id, None)
+                    raise
+                new_size = file.tell()
+
+            with FileUploadService.lock:
+                if md5_hash is not None:
+                    FileUploadService.upload_hashes[upload_id] = (new_size, md5_hash)
+                else:
+                    FileUploadService.upload_hashes.pop(upload_id, None)
+            return new_size
+
+    @staticmethod
+    def complete_upload(output_dir: str, upload_id: str) -> str:
+        """Move the uploaded file to its md5 name, returning the md5."""
+        path = FileUploadService.get_upload_path(output_dir, upload_id)
+        with FileUploadService.get_upload_lock(upload_id):
+            size = os.path.getsize(path)
+            with FileUploadService.lock:
+                hashed_size, md5_hash = FileUploadService.upload_hashes.pop(upload_id, (None, None))
+                FileUploadService.upload_locks.pop(upload_id, None)
+
+            md5 = md5_hash.hexdigest() if hashed_size == size else FileUploadService.calculate_file_md5(path)
+            return FileUploadService.move_to_md5_path(path, md5, output_dir)
@@ -1,23 +1,170 @@
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from typing import Callable, Dict, Iterator, Optional
 
 import polars as pl
-from flask import request
+from flask import Response, make_response, request
 from flask_appbuilder import expose
 from flask_appbuilder.api import BaseApi
 from loguru import logger
 from orjson import orjson
 
+from app import app
+from app.common.cache import DiskLRUCache, SizeBoundedLRUCache, TieredCache
 from app.common.errors import EmptyDataFrameError
-from app.common.request_utils import build_error_response
-from app.insight.datasource.bqMetrics import BqMetrics
-from app.insight.services.insight_builders import DFBasedInsightBuilder
-from app.insight.services.metrics import AggregateMethod, SingleColumnMetric, DualColumnMetric, CombineMethod, DimensionValuePair, Filter
-from app.insight.services.segment_insight_builder import get_related_segments, get_segment_insight, get_waterfall_insight
-from app.insight.services.utils import load_df_from_csv
+from app.common.request_utils import ARROW_STREAM_MIMETYPE, accepts_arrow_stream, build_error_response, compress_chunks, \
+    get_encoded_etag, iter_arrow_streams, negotiate_content_encoding
+from app.insight.datasource.bqMetrics import MAX_NUM_DIMENSIONS as MAX_BQ_NUM_DIMENSIONS, BqMetrics
+from app.insight.services.analysis_executor import AnalysisExecutor, AnalysisExecutorType
+from app.insight.services.daily_cube import MAX_CUBE_ROW_RATIO, DailyCube, build_daily_cube, can_roll_up, get_cube_column, get_single_column_metrics, \
+    has_cube_columns, select_cube_metrics
+from app.insight.services.insight_builders import SEGMENT_BATCH_SIZE, DFBasedInsightBuilder, InsightStage
+from app.insight.services.insight_jobs import InsightJobManager, InsightJobStatus
+from app.insight.services.metrics import AggregateMethod, SingleColumnMetric, DualColumnMetric, CombineMethod, DimensionValuePair, Filter, Metric, \
+    flatten
+from app.insight.services.sampling import SamplingOptions
+from app.insight.services.segment_insight_builder import get_related_segment_dfs, get_related_segments, get_segment_insight, get_waterfall_insight
+from app.insight.services.segment_table import SEGMENT_SORT_COLUMNS, DimensionFilter, dump_rows, get_segment_page
+from app.insight.services.utils import DateSortedFile, get_date_sorted_file, load_df_with_date
+from config import ConfigKey
 
 
 class InsightApi(BaseApi):
     resource_name = "insight"
+    temp_file_path = app.config[ConfigKey.TEMP_FILE_PATH.name]
+    dataframe_cache = SizeBoundedLRUCache(
+        "dataframe",
+        app.config[ConfigKey.DATAFRAME_CACHE_SIZE_MB.name] * 1024 * 1024,
+        lambda df: df.estimated_size()
+    )
+    result_cache = TieredCache(
+        SizeBoundedLRUCache("result", app.config[ConfigKey.RESULT_CACHE_MEMORY_SIZE_MB.name] * 1024 * 1024, len),
+        DiskLRUCache("result-disk", f"{temp_file_path}/results", app.config[ConfigKey.RESULT_CACHE_DISK_SIZE_MB.name] * 1024 * 1024)
+    )
+    segment_table_cache = SizeBoundedLRUCache(
+        "segment-table",
+        app.config[ConfigKey.SEGMENT_TABLE_CACHE_SIZE_MB.name] * 1024 * 1024,
+        lambda df: df.estimated_size()
+    )
+    # The daily cubes by file, date column and dimensions, along with the metrics they hold
+    daily_cube_cache = SizeBoundedLRUCache(
+        "daily-cube",
+        app.config[ConfigKey.DAILY_CUBE_CACHE_SIZE_MB.name] * 1024 * 1024,
+        lambda entry: entry[0].estimated_size() if entry[0] is not None else 0
+    )
+    default_segment_page_size = 100
+    max_segment_page_size = 1000
+    # Bump when the format or the content of the insights changes, so that results cached on disk are not served anymore
+    result_cache_version = 3
+    analysis_executor = AnalysisExecutor(
+        AnalysisExecutorType(app.config[ConfigKey.ANALYSIS_EXECUTOR.name]),
+        app.config[ConfigKey.ANALYSIS_MAX_WORKERS.name],
+        temp_file_path
+    )
+    # Builds the exact insights of sampled requests one at a time in the background
+    refine_executor = ThreadPoolExecutor(max_workers=1)
+    job_manager = InsightJobManager(app.config[ConfigKey.INSIGHT_JOB_MAX_WORKERS.name], app.config[ConfigKey.INSIGHT_JOB_HISTORY_SIZE.name])
+
+    def load_df(self, file_id: str, date_column: str, date_column_type: str, columns: list[str]) -> pl.DataFrame:
+        """
+        Assemble the dataset sorted by date from the cached columns, only reading the columns which are not cached yet from the
+        date sorted file. The columns are cached per date column since their row order depends on it.
+        """
+        columns = list(dict.fromkeys(columns + ["date"]))
+        series_by_column = {column: self.dataframe_cache.get((file_id, date_column, column)) for column in columns}
+        missing_columns = [column for column, series in series_by_column.items() if series is None]
+        if len(missing_columns) > 0:
+            logger.info(f'Reading columns {missing_columns} from file')
+            loaded_df = load_df_with_date(f'{self.temp_file_path}/{file_id}', date_column, missing_columns)
+            for column in missing_columns:
+                series_by_column[column] = loaded_df[column]
+                self.dataframe_cache.put((file_id, date_column, column), loaded_df[column])
+
+        return pl.DataFrame(list(series_by_column.values()))
+
+    def scan_df(self, file_id: str, date_column: str, date_column_type: str, columns: list[str]) -> pl.DataFrame | DateSortedFile:
+        """
+        Use the cached columns if all of them are cached, otherwise the date sorted file so that only the required columns of
+        the requested date ranges are read.
+        """
+        if all((file_id, date_column, column) in self.dataframe_cache for column in columns + ["date"]):
+            return self.load_df(file_id, date_column, date_column_type, columns)
+
+        logger.info('Scanning file')
+        return get_date_sorted_file(f'{self.temp_file_path}/{file_id}', date_column, columns)
+
+    def get_daily_cube(
+            self,
+            file_id: str,
+            date_column: str,
+            date_column_type: str,
+            dimensions: list[str],
+            metrics: list[Metric],
+            filters: list[Filter],
+            build: bool
+    ) -> Optional[DailyCube]:
+        """
+        The daily cube over the dimensions and the filter columns, so that any date ranges are answered by summing up the days
+        in them instead of aggregating the raw rows. There is no cube for metrics which can not be rolled up.
+
+        Without build only a cached cube is used. Otherwise a missing cube is built from the raw rows, along with the metrics of
+        the cube it replaces so that switching back and forth between metrics does not rebuild it every time. Cubes which are
+        not much smaller than the rows are dropped, which is remembered as an entry without a cube.
+        """
+        if not all(can_roll_up(metric) for metric in metrics):
+            return None
+
+        dimensions = list(dict.fromkeys(dimensions + [filter.column for filter in filters]))
+        cache_key = (file_id, date_column, tuple(sorted(dimensions)))
+        single_column_metrics = get_single_column_metrics(metrics)
+        entry = self.daily_cube_cache.get(cache_key)
+        if entry is not None and entry[0] is None:
+            return None
+
+        cube_df, cube_metrics = entry if entry is not None else (None, [])
+        if cube_df is None or not has_cube_columns(cube_df, single_column_metrics):
+            if not build:
+                return None
+
+            cube_metrics = list({get_cube_column(metric): metric for metric in cube_metrics + single_column_metrics}.values())
+            logger.info(f'Building daily cube over {dimensions}')
+            columns = self.get_required_columns(date_column, dimensions, cube_metrics, [])
+            cube_df = build_daily_cube(self.scan_df(file_id, date_column, date_column_type, columns).lazy(), dimensions, cube_metrics)
+            if cube_df.height > MAX_CUBE_ROW_RATIO * cube_df["count"].sum():
+                logger.info(f'Not using the daily cube over {dimensions}, it has {cube_df.height} rows')
+                self.daily_cube_cache.put(cache_key, (None, []))
+                return None
+            self.daily_cube_cache.put(cache_key, (cube_df, cube_metrics))
+
+        return select_cube_metrics(cube_df, dimensions, metrics)
+
+    @staticmethod
+    def get_result_cache_key(data) -> str:
+        """The file id, which is the md5 of the file, plus a hash of every request field the insights depend on."""
+        request_fields = {
+            key: data[key] for key in [
+                'baseDateRange', 'comparisonDateRange', 'dateColumn', 'dateColumnType', 'groupByColumns', 'filters', 'expectedValue',
+                'maxNumDimensions', 'minSegmentSupport', 'metricColumn', 'metricColumns', 'maxNumSegments', 'sampling'
+            ] if key in data
+        }
+        if 'groupByColumns' in request_fields:
+            request_fields['groupByColumns'] = sorted(request_fields['groupByColumns'])
+
+        hasher = hashlib.sha256()
+        hasher.update(orjson.dumps([InsightApi.result_cache_version, request_fields], option=orjson.OPT_SORT_KEYS))
+        return f"{data['fileId']}-{hasher.hexdigest()}"
+
+    @staticmethod
+    def get_segment_table_key(data, metric_id: str) -> tuple[str, str]:
+        """The segment table does not depend on how many segments the insight response includes."""
+        return InsightApi.get_result_cache_key({key: value for key, value in data.items() if key != 'maxNumSegments'}), metric_id
+
+    @staticmethod
+    def get_required_columns(date_column: str, dimensions: list[str], metrics: list[Metric], filters: list[Filter]) -> list[str]:
+        return list(dict.fromkeys(
+            [date_column] + dimensions + flatten([metric.get_columns() for metric in metrics]) + [filter.column for filter in filters]
+        ))
 
     @staticmethod
     def parse_date_info(data):
@@ -52,12 +199,45 @@ class InsightApi(BaseApi):
             baseline_start, baseline_end, comparison_start, comparison_end, date_column, date_column_type, group_by_columns, filters, num_max_dimensions
         )
 
+    @staticmethod
+    def parse_sampling_options(data) -> Optional[SamplingOptions]:
+        """The sampling of the rows requested with sampling.fraction, a fraction of one analyzes all rows exactly."""
+        if 'sampling' not in data or data['sampling'] is None:
+            return None
+
+        sampling = data['sampling']
+        fraction = sampling['fraction']
+        if not 0 < fraction <= 1:
+            raise ValueError("The sampling fraction has to be greater than 0 and at most 1")
+        if fraction == 1:
+            return None
+        return SamplingOptions(fraction, sampling['stratifyByDate'] if 'stratifyByDate' in sampling else False)
+
+    @staticmethod
+    def parse_dimension_filters(data) -> list[DimensionFilter]:
+        """The dimensionFilters of a segments request, each one a dimension and optionally the value it has to have."""
+        if 'dimensionFilters' not in data:
+            return []
+
+        dimension_filters = data['dimensionFilters']
+        if not isinstance(dimension_filters, list):
+            raise ValueError("dimensionFilters has to be a list")
+        for dimension_filter in dimension_filters:
+            if not isinstance(dimension_filter, dict) or 'dimension' not in dimension_filter \
+                    or not set(dimension_filter.keys()) <= {'dimension', 'value'}:
+                raise ValueError("Every dimension filter has to have a dimension and optionally a value")
+            if not isinstance(dimension_filter['dimension'], str) \
+                    or not isinstance(dimension_filter.get('value'), (str, type(None))):
+                raise ValueError("The dimension and value of a dimension filter have to be strings")
+        return [DimensionFilter(dimension_filter['dimension'], dimension_filter.get('value')) for dimension_filter in dimension_filters]
+
     @staticmethod
     def parse_metrics(metric_column):
         agg_method_map = {
             "sum": AggregateMethod.SUM,
             "count": AggregateMethod.COUNT,
-            "nunique": AggregateMethod.DISTINCT
+            "nunique": AggregateMethod.DISTINCT,
+            "approx_nunique": AggregateMethod.APPROX_DISTINCT
         }
 
         if metric_column['aggregationOption'] == 'ratio':
@@ -98,6 +278,15 @@ class InsightApi(BaseApi):
             )
         return metric
 
+    @staticmethod
+    def parse_metric_list(metric_columns) -> list[Metric]:
+        """Parse the metric columns, dropping the duplicated metrics."""
+        metrics = {}
+        for metric_column in metric_columns:
+            metric = InsightApi.parse_metrics(metric_column)
+            metrics[metric.get_id()] = metric
+        return list(metrics.values())
+
     @expose('bigquery/metric', methods=['POST'])
     def get_bq_insight(self):
         data = request.get_json()
@@ -105,8 +294,11 @@ class InsightApi(BaseApi):
         expected_value = data['expectedValue']
 
         (
-            baselineStart, baselineEnd, comparisonStart, comparisonEnd, date_column, date_column_type, group_by_columns, filters
+            baselineStart, baselineEnd, comparisonStart, comparisonEnd, date_column, date_column_type, group_by_columns, filters,
+            max_num_dimensions
         ) = self.parse_data(data)
+        if max_num_dimensions > MAX_BQ_NUM_DIMENSIONS:
+            return build_error_response(f"BigQuery reports support at most {MAX_BQ_NUM_DIMENSIONS} dimensions"), 400
 
         metric = self.parse_metrics(data['metricColumn'])
 
@@ -135,9 +327,14 @@ class InsightApi(BaseApi):
             filtering_clause = filtering_clause & (pl.col(
                 sub_key['dimension']).cast(str).eq(pl.lit(sub_key['value'])))
 
-        df = load_df_from_csv(f'/tmp/dsensei/{file_id}') \
-            .with_columns(pl.col(date_column).cast(pl.Utf8).str.slice(0, 10).str.to_date().alias("date")) \
-            .filter(filtering_clause)
+        # The cube of the insight the segment belongs to answers the request if it was built
+        segment_dimensions = [sub_key['dimension'] for sub_key in segment_key]
+        cube = self.get_daily_cube(file_id, date_column, date_column_type, group_by_columns + segment_dimensions, [metric], filters, False)
+        if cube is not None:
+            df = DailyCube(cube.df.filter(filtering_clause))
+        else:
+            columns = self.get_required_columns(date_column, segment_dimensions, [metric], filters)
+            df = self.load_df(file_id, date_column, date_column_type, columns).filter(filtering_clause)
 
         return orjson.dumps(
             get_segment_insight(
@@ -159,17 +356,28 @@ class InsightApi(BaseApi):
         metric = self.parse_metrics(metric_column)
         filters = self.parse_filters(data)
 
+        segment_key = [DimensionValuePair(key_component['dimension'], key_component['value']) for key_component in data['segmentKey']]
+
         file_id = data['fileId']
-        logger.info('Reading file')
-        df = load_df_from_csv(f'/tmp/dsensei/{file_id}') \
-            .with_columns(pl.col(date_column).cast(pl.Utf8).str.slice(0, 10).str.to_date().alias("date"))
+        columns = self.get_required_columns(date_column, [sub_key.dimension for sub_key in segment_key], [metric], filters)
+        df = self.load_df(file_id, date_column, date_column_type, columns)
+
+        if accepts_arrow_stream(request.accept_mimetypes):
+            segment_dfs = get_related_segment_dfs(df, (baseline_start, baseline_end), (comparison_start, comparison_end), segment_key, metric, filters)
+            return Response(
+                iter_arrow_streams(
+                    [(segment_df, {"table": "relatedSegments", "metricId": metric_id}) for metric_id, segment_df in segment_dfs.items()],
+                    SEGMENT_BATCH_SIZE
+                ),
+                mimetype=ARROW_STREAM_MIMETYPE
+            )
 
         return orjson.dumps(
             get_related_segments(
                 df,
                 (baseline_start, baseline_end),
                 (comparison_start, comparison_end),
-                [DimensionValuePair(key_component['dimension'], key_component['value']) for key_component in data['segmentKey']],
+                segment_key,
                 metric,
                 filters
             )
@@ -187,50 +395,295 @@ class InsightApi(BaseApi):
         metric = self.parse_metrics(metric_column)
         filters = self.parse_filters(data)
 
+        segment_keys = [_build_dimension_value_pair(segment_key) for segment_key in data['segmentKeys']]
+
         file_id = data['fileId']
-        logger.info('Reading file')
-        df = load_df_from_csv(f'/tmp/dsensei/{file_id}', date_column) \
-            .with_columns(pl.col(date_column).cast(pl.Utf8).str.slice(0, 10).str.to_date().alias("date"))
+        columns = self.get_required_columns(date_column, [sub_key.dimension for sub_key in flatten(segment_keys)], [metric], filters)
+        df = self.load_df(file_id, date_column, date_column_type, columns)
 
         return orjson.dumps(get_waterfall_insight(
             df,
             (baseline_start, baseline_end),
             (comparison_start, comparison_end),
-            [_build_dimension_value_pair(segment_key) for segment_key in data['segmentKeys']],
+            segment_keys,
             metric,
             filters
         ))
 
-    @expose('file/metric', methods=['POST'])
-    def get_insight(self):
-        data = request.get_json()
+    @expose('cache/stats', methods=['GET'])
+    def get_cache_stats(self):
+        return orjson.dumps({
+            cache.name: cache.get_stats()
+            for cache in [
+                self.dataframe_cache, self.result_cache.memory_cache, self.result_cache.disk_cache, self.segment_table_cache, self.daily_cube_cache
+            ]
+        })
+
+    def build_file_insight(self, data, metrics: list[Metric]):
+        """
+        Stream the insights, compressed if the client accepts it. They are served from the result cache if the same request
+        was built before, the cache key suffixed with the content encoding doubles as the ETag. With maxNumSegments only the
+        top segments are included, the others can be fetched page by page from file/segments.
+
+        Clients accepting application/vnd.apache.arrow.stream get the segment tables and value by date series as Arrow
+        streams written from the frames instead, see DFBasedInsightBuilder.build_tables.
+
+        Requests with sampling get insights estimated from a sample of the rows, flagged with isSampled. With sampling.refine
+        the exact insights are built in the background once the sampled ones were sent, to be served from the result cache to
+        the same request without sampling.
+        """
+        try:
+            self.parse_sampling_options(data)
+        except (KeyError, TypeError, ValueError) as e:
+            return build_error_response(f"Invalid sampling: {e}"), 400
+
+        arrow = accepts_arrow_stream(request.accept_mimetypes)
+        cache_key = self.get_result_cache_key(data) + ("-arrow" if arrow else "")
+        content_encoding = negotiate_content_encoding(request.accept_encodings)
+        etag = get_encoded_etag(cache_key, content_encoding)
+        if request.if_none_match.contains(etag):
+            response = make_response("", 304)
+            response.headers["Vary"] = "Accept, Accept-Encoding"
+            response.set_etag(etag)
+            return response
+
+        result = self.result_cache.get(cache_key)
+        if result is not None:
+            chunks = [result]
+        else:
+            try:
+                insight_builder = self.create_insight_builder(data, metrics)
+                # Only the serialization is streamed, failures before it still get an error response
+                insight_builder.build_metric_insights()
+            except EmptyDataFrameError:
+                return build_error_response("EMPTY_DATASET"), 400
+            except Exception as e:
+                logger.exception(e)
+                return build_error_response(str(e)), 500
+            max_num_segments = data['maxNumSegments'] if 'maxNumSegments' in data else None
+            if arrow:
+                chunks = iter_arrow_streams(insight_builder.build_tables(max_num_segments), SEGMENT_BATCH_SIZE)
+            else:
+                chunks = insight_builder.build_chunks(max_num_segments)
+            chunks = self.cache_chunks(cache_key, data, insight_builder, chunks)
+            if insight_builder.sampling_options is not None and 'refine' in data['sampling'] and data['sampling']['refine']:
+                chunks = self.refine_after(chunks, data, metrics, arrow)
+
+        response = Response(compress_chunks(chunks, content_encoding), mimetype=ARROW_STREAM_MIMETYPE if arrow else "application/json")
+        if content_encoding is not None:
+            response.headers["Content-Encoding"] = content_encoding
+        response.headers["Vary"] = "Accept, Accept-Encoding"
+        response.set_etag(etag)
+        return response
+
+    def cache_chunks(self, cache_key: str, data, insight_builder: DFBasedInsightBuilder, chunks: Iterator[bytes]) -> Iterator[bytes]:
+        """Pass the chunks of the builder through, and cache the whole result and the segment tables once all of them were sent."""
+        sent_chunks = []
+        try:
+            for chunk in chunks:
+                sent_chunks.append(chunk)
+                yield chunk
+        except Exception as e:
+            logger.exception(e)
+            raise
+        self.result_cache.put(cache_key, b"".join(sent_chunks))
+        self.cache_segment_tables(data, insight_builder.segment_info_dfs)
+
+    def refine_after(self, chunks: Iterator[bytes], data, metrics: list[Metric], arrow: bool) -> Iterator[bytes]:
+        """Pass the chunks of a sampled response through, then build the exact insights into the result cache in the background."""
+        yield from chunks
+
+        exact_data = {key: value for key, value in data.items() if key != 'sampling'}
+        cache_key = self.get_result_cache_key(exact_data) + ("-arrow" if arrow else "")
+        max_num_segments = data['maxNumSegments'] if 'maxNumSegments' in data else None
+
+        def _refine():
+            if self.result_cache.get(cache_key) is not None:
+                return
+            logger.info('Refining sampled insights')
+            try:
+                insight_builder = self.create_insight_builder(exact_data, metrics)
+                if arrow:
+                    exact_chunks = iter_arrow_streams(insight_builder.build_tables(max_num_segments), SEGMENT_BATCH_SIZE)
+                else:
+                    exact_chunks = insight_builder.build_chunks(max_num_segments)
+                for _ in self.cache_chunks(cache_key, exact_data, insight_builder, exact_chunks):
+                    pass
+            except Exception as e:
+                logger.exception(e)
+
+        self.refine_executor.submit(_refine)
+
+    def cache_segment_tables(self, data, segment_info_dfs: Dict[str, pl.DataFrame]):
+        for metric_id, segment_info_df in segment_info_dfs.items():
+            self.segment_table_cache.put(self.get_segment_table_key(data, metric_id), segment_info_df)
+
+    def get_segment_table(self, data, metric_id: str) -> Optional[pl.DataFrame]:
+        """The cached segment table of the metric, rebuilt along with the tables of the other requested metrics if it was evicted."""
+        segment_info_df = self.segment_table_cache.get(self.get_segment_table_key(data, metric_id))
+        if segment_info_df is not None:
+            return segment_info_df
+
+        metric_columns = data['metricColumns'] if 'metricColumns' in data else [data['metricColumn']]
+        segment_info_dfs = self.create_insight_builder(data, self.parse_metric_list(metric_columns)).build_segment_info_dfs()
+        self.cache_segment_tables(data, segment_info_dfs)
+        return segment_info_dfs.get(metric_id)
+
+    def create_insight_builder(
+            self, data, metrics: list[Metric], on_stage: Optional[Callable[[InsightStage], None]] = None
+    ) -> DFBasedInsightBuilder:
         file_id = data['fileId']
         expected_value = data['expectedValue']
         (baselineStart, baselineEnd, comparisonStart, comparisonEnd, date_column, date_column_type, group_by_columns, filters,
          max_num_dimensions) = self.parse_data(data)
+        min_segment_support = data['minSegmentSupport'] if 'minSegmentSupport' in data else None
+        sampling_options = self.parse_sampling_options(data)
+
+        if on_stage is not None:
+            on_stage(InsightStage.LOAD)
+        # A cached daily cube answers sampled requests exactly at a fraction of the cost, but is not worth building for them
+        df = self.get_daily_cube(file_id, date_column, date_column_type, group_by_columns, metrics, filters, sampling_options is None)
+        if df is None:
+            columns = self.get_required_columns(date_column, group_by_columns, metrics, filters)
+            df = self.scan_df(file_id, date_column, date_column_type, columns)
+
+        return DFBasedInsightBuilder(
+            df,
+            (baselineStart, baselineEnd),
+            (comparisonStart, comparisonEnd),
+            group_by_columns,
+            metrics,
+            expected_value,
+            filters,
+            max_num_dimensions,
+            self.analysis_executor,
+            min_segment_support,
+            sampling_options=sampling_options,
+            on_stage=on_stage
+        )
 
-        metric_column = data['metricColumn']
-        metric = self.parse_metrics(metric_column)
+    @expose('file/metric', methods=['POST'])
+    def get_insight(self):
+        data = request.get_json()
+        return self.build_file_insight(data, [self.parse_metrics(data['metricColumn'])])
+
+    @expose('file/metrics', methods=['POST'])
+    def get_insights(self):
+        """Build the insights of several metrics over the same file, date ranges and group-by columns in one pass."""
+        data = request.get_json()
+        metrics = self.parse_metric_list(data['metricColumns'])
+
+        if len(metrics) == 0:
+            return build_error_response("No metric columns"), 400
+        return self.build_file_insight(data, metrics)
+
+    @expose('file/segments', methods=['POST'])
+    def get_segments(self):
+        """
+        One page of the segments of a metric, ranked by sortBy and keeping the segments which match all dimensionFilters. The
+        request repeats the fields of the file/metric or file/metrics request the segments belong to, the cursor is the one
+        returned with the previous page.
+        """
+        data = request.get_json()
+        metric_id = data['metricId']
+        sort_by = data['sortBy'] if 'sortBy' in data else 'sort'
+        page_size = data['pageSize'] if 'pageSize' in data else self.default_segment_page_size
+        cursor = data['cursor'] if 'cursor' in data else None
 
         try:
-            logger.info('Reading file')
-            df = load_df_from_csv(f'/tmp/dsensei/{file_id}', date_column) \
-                .with_columns(pl.col(date_column).cast(pl.Utf8).str.slice(0, 10).str.to_date(strict=False).alias("date"))
+            dimension_filters = self.parse_dimension_filters(data)
+        except ValueError as e:
+            return build_error_response(f"Invalid dimensionFilters: {e}"), 400
+        if sort_by not in SEGMENT_SORT_COLUMNS:
+            return build_error_response(f"Cannot sort segments by {sort_by}"), 400
+        if not isinstance(page_size, int) or isinstance(page_size, bool) or page_size <= 0:
+            return build_error_response("pageSize has to be a positive integer"), 400
+        if cursor is not None and not str(cursor).isdigit():
+            return build_error_response("Invalid cursor"), 400
+        offset = int(cursor) if cursor is not None else 0
 
-            logger.info('File loaded')
-            insight_builder = DFBasedInsightBuilder(
-                df,
-                (baselineStart, baselineEnd),
-                (comparisonStart, comparisonEnd),
-                group_by_columns,
-                [metric],
-                expected_value,
-                filters,
-                max_num_dimensions
-            )
-            return insight_builder.build()
+        try:
+            segment_info_df = self.get_segment_table(data, metric_id)
         except EmptyDataFrameError:
             return build_error_response("EMPTY_DATASET"), 400
         except Exception as e:
             logger.exception(e)
             return build_error_response(str(e)), 500
+        if segment_info_df is None:
+            return build_error_response(f"Unknown metric {metric_id}"), 400
+
+        page_df, num_segments = get_segment_page(segment_info_df, sort_by, dimension_filters, offset, min(page_size, self.max_segment_page_size))
+        next_offset = offset + page_df.height
+        return orjson.dumps({
+            "segments": orjson.Fragment(dump_rows(page_df)),
+            "totalSegments": num_segments,
+            "nextCursor": str(next_offset) if next_offset < num_segments else None
+        })
+
+    def run_insight_job(self, data, metrics: list[Metric], on_stage: Callable[[InsightStage], None]) -> str:
+        """Build the insights of a job into the result cache unless they are cached already, returning their cache key."""
+        cache_key = self.get_result_cache_key(data)
+        if self.result_cache.get(cache_key) is not None:
+            return cache_key
+
+        insight_builder = self.create_insight_builder(data, metrics, on_stage)
+        insight_builder.build_metric_insights()
+        max_num_segments = data['maxNumSegments'] if 'maxNumSegments' in data else None
+        on_stage(InsightStage.SERIALIZATION)
+        for _ in self.cache_chunks(cache_key, data, insight_builder, insight_builder.build_chunks(max_num_segments)):
+            on_stage(InsightStage.SERIALIZATION)
+        return cache_key
+
+    @expose('file/jobs', methods=['POST'])
+    def submit_insight_job(self):
+        """
+        Build the insights of a file/metric or file/metrics request in the background. The returned job id is polled with
+        GET file/jobs/<job_id> and the insights are fetched from file/jobs/<job_id>/result once the job succeeded.
+        """
+        data = request.get_json()
+        metric_columns = data['metricColumns'] if 'metricColumns' in data else [data['metricColumn']]
+        metrics = self.parse_metric_list(metric_columns)
+        if len(metrics) == 0:
+            return build_error_response("No metric columns"), 400
+        try:
+            self.parse_sampling_options(data)
+        except (KeyError, TypeError, ValueError) as e:
+            return build_error_response(f"Invalid sampling: {e}"), 400
+
+        job = self.job_manager.submit(lambda on_stage: self.run_insight_job(data, metrics, on_stage))
+        return orjson.dumps(job.to_json()), 202
+
+    @expose('file/jobs/<job_id>', methods=['GET'])
+    def get_insight_job(self, job_id: str):
+        job = self.job_manager.get(job_id)
+        if job is None:
+            return build_error_response("Job not found"), 404
+        return orjson.dumps(job.to_json())
+
+    @expose('file/jobs/<job_id>', methods=['DELETE'])
+    def cancel_insight_job(self, job_id: str):
+        """Cancel the job, a running job stops at its next stage or step. Finished jobs are left as they are."""
+        job = self.job_manager.cancel(job_id)
+        if job is None:
+            return build_error_response("Job not found"), 404
+        return orjson.dumps(job.to_json())
+
+    @expose('file/jobs/<job_id>/result', methods=['GET'])
+    def get_insight_job_result(self, job_id: str):
+        job = self.job_manager.get(job_id)
+        if job is None:
+            return build_error_response("Job not found"), 404
+        if job.status != InsightJobStatus.SUCCEEDED:
+            return orjson.dumps(dict(job.to_json(), error=job.error or f"The job is {job.status}")), 409
+
+        result = self.result_cache.get(job.result_key)
+        if result is None:
+            return build_error_response("The result was evicted, submit the job again"), 410
+
+        content_encoding = negotiate_content_encoding(request.accept_encodings)
+        response = Response(compress_chunks([result], content_encoding), mimetype="application/json")
+        if content_encoding is not None:
+            response.headers["Content-Encoding"] = content_encoding
+        response.headers["Vary"] = "Accept-Encoding"
+        response.set_etag(get_encoded_etag(job.result_key, content_encoding))
+        return response
@@ -12,6 +12,9 @@ from app.insight.services.metrics import (Dimension, SegmentInfo,
                                           DimensionValuePair, MetricInsight,
                                           NpEncoder, PeriodValue, calculate_total_segments, find_key_dimensions, Metric, AggregateMethod)
 
+# The sub queries only keep the segments of up to this many dimensions
+MAX_NUM_DIMENSIONS = 3
+
 SUB_QUERY_TEMPLATE = """
 SELECT
   count(*) as _cnt,
@@ -26,6 +29,34 @@ GROUP BY
 HAVING {} > {}
 """
 
+# The rows aggregated by the dimensions, so that the "ALL" expansion of ROLLUP_SUB_QUERY_TEMPLATE runs over one row per
+# combination instead of every row of the table. Approximate distinct counts are kept as HLL++ sketches, which merge into
+# the estimate of any union of combinations with the ~1% error of APPROX_COUNT_DISTINCT.
+PRE_AGGREGATE_TEMPLATE = """
+SELECT
+  count(*) as _cnt,
+  {},
+  {}
+FROM
+  `{}`
+WHERE {} BETWEEN TIMESTAMP('{}') AND TIMESTAMP('{}')
+GROUP BY
+  {}
+"""
+
+ROLLUP_SUB_QUERY_TEMPLATE = """
+SELECT
+  SUM(_cnt) as _cnt,
+  {},
+  {}
+FROM
+  ({}),
+  {}
+GROUP BY
+  {}
+HAVING {} > {}
+"""
+
 METRIC_BY_DATE = """
 SELECT
   {},
@@ -107,64 +138,101 @@ class BqMetrics():
                 agg.append(f'COUNT(DISTINCT {metric.column}) AS {metric.get_id()}')
             elif metric.get_metric_type() == AggregateMethod.COUNT.name:
                 agg.append(f'COUNT({metric.column}) AS {metric.get_id()}')
+            elif metric.get_metric_type() == AggregateMethod.APPROX_DISTINCT.name:
+                agg.append(f'APPROX_COUNT_DISTINCT({metric.column}) AS {metric.get_id()}')
             else:
                 raise Exception(f'Invalid aggregation method {metric.get_metric_type()} for {metric.column}')
         return agg
 
-    def _prepare_value_by_date_query(self) -> str:
-        agg = self._get_agg()
+    def _can_pre_aggregate(self) -> bool:
+        """Whether the metrics of a segment can be rolled up from the combinations of dimension values in it."""
+        return all(metric.get_metric_type() in [
+            AggregateMethod.SUM.name, AggregateMethod.COUNT.name, AggregateMethod.APPROX_DISTINCT.name
+        ] for metric in self.metrics)
 
-        query = METRIC_BY_DATE.format(
-            ',\n'.join(agg),
-            self.date_column_converted,
-            self.table_name,
-            self.date_column_converted,
-            self.baseline_period[0],
-            self.comparison_period[1] + datetime.timedelta(days=1))
-        return query
+    def _get_pre_aggregation_agg(self) -> List[str]:
+        agg = []
+        for metric in self.metrics:
+            if metric.get_metric_type() == AggregateMethod.APPROX_DISTINCT.name:
+                agg.append(f'HLL_COUNT.INIT(CAST({metric.column} AS STRING)) AS {metric.get_id()}_sketch')
+            elif metric.get_metric_type() == AggregateMethod.SUM.name:
+                agg.append(f'SUM({metric.column}) AS {metric.get_id()}')
+            else:
+                agg.append(f'COUNT({metric.column}) AS {metric.get_id()}')
+        return agg
 
-    def _prepare_query(self) -> str:
-        groupby_columns = self.columns
+    def _get_rollup_agg(self) -> List[str]:
+        return [
+            f'HLL_COUNT.MERGE({metric.get_id()}_sketch) AS {metric.get_id()}'
+            if metric.get_metric_type() == AggregateMethod.APPROX_DISTINCT.name
+            else f'SUM({metric.get_id()}) AS {metric.get_id()}'
+            for metric in self.metrics
+        ]
+
+    def _prepare_sub_query(self, period: Tuple[datetime.date, datetime.date]) -> str:
+        columns_to_select = [
+            f"CAST({x} AS STRING) AS {x}" for x in self.columns
+        ]
         column_value_all_count = '+'.join(
             map(lambda x: f"IF({x}='ALL', 1, 0)", self.columns))
-        joined_column_value_all_count = 'COALESCE(' + '+'.join(map(lambda x: f"IF(comparison.{x}='ALL', 1, 0)", self.columns)) + ',' + '+'.join(
-            map(lambda x: f"IF(baseline.{x}='ALL', 1, 0)", self.columns)) + ') AS count_all_values'
         unnest_columns = list(map(
             lambda x: f'UNNEST([CAST({x} AS STRING), "ALL"]) AS {x}',
             self.columns
         ))
-        date_column = self.date_column
-        agg = self._get_agg()
-        metric_column = [metric.get_id() for metric in self.metrics]
 
-        columns_to_select = [
-            f"CAST({x} AS STRING) AS {x}" for x in groupby_columns
-        ]
-        baseline_query = SUB_QUERY_TEMPLATE.format(
-            ',\n'.join(columns_to_select),
-            ',\n'.join(agg),
+        if not self._can_pre_aggregate():
+            return SUB_QUERY_TEMPLATE.format(
+                ',\n'.join(columns_to_select),
+                ',\n'.join(self._get_agg()),
+                self.table_name,
+                ',\n'.join(unnest_columns),
+                self.date_column_converted,
+                period[0],
+                period[1] + datetime.timedelta(days=1),
+                ',\n'.join(self.columns),
+                column_value_all_count,
+                len(columns_to_select) - 4  # group by up to 4 dimensions
+            )
+
+        pre_aggregate_query = PRE_AGGREGATE_TEMPLATE.format(
+            ',\n'.join(self.columns),
+            ',\n'.join(self._get_pre_aggregation_agg()),
             self.table_name,
-            ',\n'.join(unnest_columns),
             self.date_column_converted,
-            self.baseline_period[0],
-            self.baseline_period[1] + datetime.timedelta(days=1),
-            ',\n'.join(groupby_columns),
+            period[0],
+            period[1] + datetime.timedelta(days=1),
+            ',\n'.join(self.columns)
+        )
+        return ROLLUP_SUB_QUERY_TEMPLATE.format(
+            ',\n'.join(columns_to_select),
+            ',\n'.join(self._get_rollup_agg()),
+            pre_aggregate_query,
+            ',\n'.join(unnest_columns),
+            ',\n'.join(self.columns),
             column_value_all_count,
             len(columns_to_select) - 4  # group by up to 4 dimensions
         )
 
-        comparison_query = SUB_QUERY_TEMPLATE.format(
-            ',\n'.join(columns_to_select),
+    def _prepare_value_by_date_query(self) -> str:
+        agg = self._get_agg()
+
+        query = METRIC_BY_DATE.format(
             ',\n'.join(agg),
+            self.date_column_converted,
             self.table_name,
-            ',\n'.join(unnest_columns),
             self.date_column_converted,
-            self.comparison_period[0],
-            self.comparison_period[1] + datetime.timedelta(days=1),
-            ',\n'.join(groupby_columns),
-            column_value_all_count,
-            len(columns_to_select) - 4  # group by up to 4 dimensions
-        )
+            self.baseline_period[0],
+            self.comparison_period[1] + datetime.timedelta(days=1))
+        return query
+
+    def _prepare_query(self) -> str:
+        groupby_columns = self.columns
+        joined_column_value_all_count = 'COALESCE(' + '+'.join(map(lambda x: f"IF(comparison.{x}='ALL', 1, 0)", self.columns)) + ',' + '+'.join(
+            map(lambda x: f"IF(baseline.{x}='ALL', 1, 0)", self.columns)) + ') AS count_all_values'
+        metric_column = [metric.get_id() for metric in self.metrics]
+
+        baseline_query = self._prepare_sub_query(self.baseline_period)
+        comparison_query = self._prepare_sub_query(self.comparison_period)
 
         # TODO: Add support for other types, like int
         select_values = [
@@ -205,7 +273,7 @@ class BqMetrics():
             metric_column[0],
             metric_column[0],
             metric_column[0],
-            len(columns_to_select) - 1
+            len(groupby_columns) - 1
         )
         return query
 
@@ -0,0 +1,90 @@
+import math
+import multiprocessing
+import os
+import uuid
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from enum import StrEnum
+from threading import Lock
+from typing import Any, Callable, List, Optional
+
+import polars as pl
+from loguru import logger
+
+FrameTask = Callable[[pl.DataFrame, Any, Any], pl.DataFrame]
+
+
+class AnalysisExecutorType(StrEnum):
+    THREAD = "thread"
+    PROCESS = "process"
+    SEQUENTIAL = "sequential"
+
+
+def _run_tasks(df: pl.DataFrame, task: FrameTask, task_args: List[Any], context: Any) -> List[pl.DataFrame]:
+    return [task(df, task_arg, context) for task_arg in task_args]
+
+
+def _run_tasks_on_ipc_file(path: str, task: FrameTask, task_args: List[Any], context: Any) -> List[pl.DataFrame]:
+    return _run_tasks(pl.read_ipc(path, memory_map=True), task, task_args, context)
+
+
+class AnalysisExecutor:
+    """
+    Runs the same task over one shared data frame for a list of arguments, e.g. one group-by per dimension combination.
+
+    The thread backend shares the frame in memory, the process backend writes it once as an Arrow IPC file which the worker
+    processes memory map, so that the python side of every task runs outside of the GIL of the web server.
+    """
+
+    def __init__(self, executor_type: AnalysisExecutorType, max_workers: Optional[int] = None, temp_file_path: str = "/tmp/dsensei"):
+        self.executor_type = executor_type
+        self.max_workers = max_workers if max_workers is not None else os.cpu_count() or 1
+        self.temp_file_path = temp_file_path
+
+        self.executor: Optional[Executor] = None
+        self.lock = Lock()
+
+    def get_executor(self) -> Executor:
+        with self.lock:
+            if self.executor is None:
+                if self.executor_type == AnalysisExecutorType.PROCESS:
+                    # Split the cores between the workers instead of every worker starting a polars thread pool of all cores. The thread
+                    # pool of this process is already initialized, so the variable only applies to the spawned workers.
+                    os.environ["POLARS_MAX_THREADS"] = str(max(1, (os.cpu_count() or 1) // self.max_workers))
+                    # Forking a process which already runs the polars thread pool can deadlock the child
+                    self.executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+                else:
+                    self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            return self.executor
+
+    def map(self, task: Callable[..., pl.DataFrame], task_args: List[tuple]) -> List[pl.DataFrame]:
+        """Run task(*task_arg) for every task argument, the arguments are pickled for the process backend so they should be small."""
+        if self.executor_type == AnalysisExecutorType.SEQUENTIAL or len(task_args) <= 1:
+            return [task(*task_arg) for task_arg in task_args]
+
+        futures = [self.get_executor().submit(task, *task_arg) for task_arg in task_args]
+        return [future.result() for future in futures]
+
+    def map_frame(self, task: FrameTask, df: pl.DataFrame, task_args: List[Any], context: Any = None) -> List[pl.DataFrame]:
+        """Run task(df, task_arg, context) for every task argument, returning the results in the order of the arguments."""
+        if self.executor_type == AnalysisExecutorType.SEQUENTIAL or len(task_args) <= 1:
+            return _run_tasks(df, task, task_args, context)
+
+        if self.executor_type == AnalysisExecutorType.THREAD:
+            futures = [self.get_executor().submit(task, df, task_arg, context) for task_arg in task_args]
+            return [future.result() for future in futures]
+
+        os.makedirs(f"{self.temp_file_path}/analysis", exist_ok=True)
+        path = f"{self.temp_file_path}/analysis/{uuid.uuid4()}.arrow"
+        df.write_ipc(path)
+        try:
+            chunk_size = math.ceil(len(task_args) / (self.max_workers * 4))
+            futures = [
+                self.get_executor().submit(_run_tasks_on_ipc_file, path, task, task_args[i:i + chunk_size], context)
+                for i in range(0, len(task_args), chunk_size)
+            ]
+            return [result for future in futures for result in future.result()]
+        finally:
+            try:
+                os.remove(path)
+            except OSError:
+                logger.warning(f"Failed to remove {path}")
@@ -0,0 +1,201 @@
+from dataclasses import dataclass
+from itertools import combinations
+from typing import Dict, List, Optional, Tuple
+
+import polars as pl
+from loguru import logger
+
+from app.insight.services.analysis_executor import AnalysisExecutor
+from app.insight.services.metrics import Metric, SingleColumnMetric, flatten
+from app.insight.services.sketches import estimate_distinct_counts, get_sketch_column, get_sketched_metrics, merge_distinct_sketches
+
+Combination = Tuple[str, ...]
+# The dimension names and the dimension value codes of a segment
+Segment = Tuple[List[str], List[int]]
+
+
+@dataclass
+class CubeColumns:
+    """
+    The columns of the joined table which are aggregated by the segment analysis. The additive columns are summed up, ratios
+    are derived from them afterwards. The sketches of the approximate distinct counts are merged instead, and the counts
+    estimated from the merged sketches, by value column.
+    """
+    additive_columns: List[str]
+    sketch_columns: Dict[str, str]
+
+    def get_aggregation_exprs(self) -> List[pl.Expr]:
+        return [pl.sum(column) for column in self.additive_columns] + [
+            merge_distinct_sketches(pl.col(sketch_column)).alias(sketch_column) for sketch_column in self.sketch_columns.values()
+        ]
+
+    def get_estimation_exprs(self) -> List[pl.Expr]:
+        return [estimate_distinct_counts(pl.col(sketch_column)).alias(column) for column, sketch_column in self.sketch_columns.items()]
+
+    def get_columns(self) -> List[str]:
+        return self.additive_columns + list(self.sketch_columns.keys()) + list(self.sketch_columns.values())
+
+
+def get_cube_columns(metrics: List[Metric], extra_columns: Optional[List[str]] = None) -> CubeColumns:
+    """The extra columns are further additive columns of the joined table, which are aggregated along with the metrics."""
+    metric_columns = flatten([
+        [metric.get_id()] if isinstance(metric, SingleColumnMetric) else [metric.numerator_metric.get_id(), metric.denominator_metric.get_id()]
+        for metric in metrics
+    ])
+    sketched_columns = [metric.get_id() for metric in get_sketched_metrics(metrics)]
+    additive_columns = [column for column in metric_columns if column not in sketched_columns] + (extra_columns or [])
+
+    return CubeColumns(
+        additive_columns + [f"{column}_baseline" for column in additive_columns] + ["count", "count_baseline"],
+        dict(
+            [(column, get_sketch_column(column)) for column in sketched_columns] +
+            [(f"{column}_baseline", f"{get_sketch_column(column)}_baseline") for column in sketched_columns]
+        )
+    )
+
+
+def aggregate_combination(df: pl.DataFrame, columns: Combination, cube_columns: CubeColumns) -> pl.DataFrame:
+    return df.groupby(list(columns)).agg(cube_columns.get_aggregation_exprs()).with_columns(cube_columns.get_estimation_exprs())
+
+
+def plan_cube(column_combinations: List[Combination]) -> List[List[Combination]]:
+    """Group the combinations into levels by their number of dimensions, from the finest level down to the single dimensions."""
+    levels: Dict[int, List[Combination]] = {}
+    for columns in column_combinations:
+        levels.setdefault(len(columns), []).append(tuple(columns))
+    return [levels[size] for size in sorted(levels.keys(), reverse=True)]
+
+
+def build_cube(
+        joined_df: pl.DataFrame,
+        column_combinations: List[Combination],
+        metrics: List[Metric],
+        executor: AnalysisExecutor,
+        extra_columns: Optional[List[str]] = None
+) -> Dict[Combination, pl.DataFrame]:
+    """
+    Aggregate the additive columns of the joined table by every combination. Only the finest level is aggregated from the
+    joined table, every other combination is rolled up from the smallest already aggregated combination containing it.
+    """
+    cube_columns = get_cube_columns(metrics, extra_columns)
+    cube: Dict[Combination, pl.DataFrame] = {}
+
+    for level in plan_cube(column_combinations):
+        roots = []
+        rollups = []
+        for columns in level:
+            parents = [parent for parent in cube.keys() if len(parent) == len(columns) + 1 and set(columns).issubset(parent)]
+            if len(parents) == 0:
+                roots.append(columns)
+            else:
+                smallest_parent = min(parents, key=lambda parent: cube[parent].height)
+                rollups.append((cube[smallest_parent], columns, cube_columns))
+
+        if len(roots) > 0:
+            logger.info(f"Aggregating {len(roots)} combinations from the joined table")
+            cube.update(zip(roots, executor.map_frame(aggregate_combination, joined_df, roots, cube_columns)))
+        if len(rollups) > 0:
+            logger.info(f"Rolling up {len(rollups)} combinations from their parents")
+            cube.update(zip([columns for _, columns, _ in rollups], executor.map(aggregate_combination, rollups)))
+
+    return cube
+
+
+def _segment_hash(columns: Combination) -> pl.Expr:
+    return pl.struct(list(columns)).hash()
+
+
+def _frequent_column_name(columns: Combination) -> str:
+    return f"__frequent:{'|'.join(columns)}"
+
+
+def aggregate_frequent_candidates(df: pl.DataFrame, columns: Combination, context: Tuple[CubeColumns, float]) -> pl.DataFrame:
+    """Aggregate the rows whose sub-segments are all frequent, and keep the frequent segments."""
+    cube_columns, min_count = context
+
+    return df.lazy() \
+        .filter(pl.all_horizontal([pl.col(_frequent_column_name(subset)) for subset in combinations(columns, len(columns) - 1)])) \
+        .groupby(list(columns)) \
+        .agg(cube_columns.get_aggregation_exprs()) \
+        .filter(pl.col("count") + pl.col("count_baseline") >= min_count) \
+        .with_columns(cube_columns.get_estimation_exprs()) \
+        .collect()
+
+
+def build_pruned_cube(
+        joined_df: pl.DataFrame,
+        column_combinations: List[Combination],
+        metrics: List[Metric],
+        min_count: float,
+        executor: AnalysisExecutor,
+        extra_columns: Optional[List[str]] = None
+) -> Dict[Combination, pl.DataFrame]:
+    """
+    Aggregate the combinations level by level from the single dimensions up, Apriori style. A segment can only cover as many
+    rows as each of its sub-segments, so a combination is only aggregated over the rows whose sub-segments all have at least
+    min_count rows, and its segments below min_count are dropped. The single dimension segments are always kept in full since
+    the dimension scores are derived from them.
+    """
+    cube_columns = get_cube_columns(metrics, extra_columns)
+    cube: Dict[Combination, pl.DataFrame] = {}
+    frequent_hashes: Dict[Combination, pl.Series] = {}
+
+    for level in reversed(plan_cube(column_combinations)):
+        if len(level[0]) == 1:
+            cube.update(zip(level, executor.map_frame(aggregate_combination, joined_df, level, cube_columns)))
+            for columns in level:
+                frequent_hashes[columns] = cube[columns] \
+                    .filter(pl.col("count") + pl.col("count_baseline") >= min_count) \
+                    .select(_segment_hash(columns)) \
+                    .to_series()
+            continue
+
+        candidates = [
+            columns for columns in level
+            if all(len(frequent_hashes[subset]) > 0 for subset in combinations(columns, len(columns) - 1))
+        ]
+        for columns in level:
+            if columns not in candidates:
+                cube[columns] = joined_df.select(list(columns) + cube_columns.get_columns()).clear()
+
+        logger.info(f"Aggregating {len(candidates)} of {len(level)} combinations with {len(level[0])} dimensions after pruning")
+        if len(candidates) > 0:
+            # Flag the rows of the frequent sub-segments once per sub-combination rather than once per candidate containing it
+            subsets = list(dict.fromkeys(subset for columns in candidates for subset in combinations(columns, len(columns) - 1)))
+            candidate_df = joined_df.with_columns([
+                _segment_hash(subset).is_in(frequent_hashes[subset]).alias(_frequent_column_name(subset)) for subset in subsets
+            ])
+            cube.update(zip(candidates, executor.map_frame(aggregate_frequent_candidates, candidate_df, candidates, (cube_columns, min_count))))
+
+        for columns in level:
+            frequent_hashes[columns] = cube[columns].select(_segment_hash(columns)).to_series()
+
+    return cube
+
+
+def _segment_filter(segment: Segment) -> pl.Expr:
+    segment_filter = pl.lit(True)
+    for column, value in zip(*segment):
+        segment_filter = segment_filter & pl.col(column).eq(value)
+    return segment_filter
+
+
+def aggregate_segment_children(
+        df: pl.DataFrame,
+        task_arg: Tuple[Combination, List[Segment]],
+        context: Tuple[CubeColumns, Optional[float]]
+) -> pl.DataFrame:
+    """
+    Aggregate the segments of a combination which extend any of the given parent segments by one dimension. The rows of a
+    child segment all belong to its parent, so the aggregates are as exact as the ones of the full combination.
+    """
+    columns, parents = task_arg
+    cube_columns, min_count = context
+
+    df = df.lazy() \
+        .filter(pl.any_horizontal([_segment_filter(parent) for parent in parents])) \
+        .groupby(list(columns)) \
+        .agg(cube_columns.get_aggregation_exprs())
+    if min_count is not None:
+        df = df.filter(pl.col("count") + pl.col("count_baseline") >= min_count)
+    return df.with_columns(cube_columns.get_estimation_exprs()).collect()
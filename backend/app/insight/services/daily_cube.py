@@ -0,0 +1,98 @@
+import dataclasses
+from dataclasses import dataclass
+from typing import List
+
+import polars as pl
+
+from app.insight.services.metrics import AggregateMethod, DualColumnMetric, Metric, SingleColumnMetric, flatten
+from app.insight.services.sketches import build_distinct_sketch, estimate_distinct_count, merge_distinct_sketches
+
+# Aggregations which can be computed for a date range by summing up their values of the days in it
+ADDITIVE_AGGREGATE_METHODS = [AggregateMethod.SUM, AggregateMethod.COUNT]
+# Cubes with more rows than this share of the rows they aggregate save too little work to be kept
+MAX_CUBE_ROW_RATIO = 0.25
+
+
+@dataclass
+class DailyCube:
+    """
+    The rows aggregated by date and dimensions, with the row count and the value or the distinct count sketch of the metrics
+    for every combination of them. The frame is sorted by date and its metric columns are named by the metric ids.
+    """
+    df: pl.DataFrame
+
+
+def can_roll_up(metric: Metric) -> bool:
+    """Whether the value of a date range can be derived from the days in it, by summing up their values or merging their sketches."""
+    if isinstance(metric, DualColumnMetric):
+        return can_roll_up(metric.numerator_metric) and can_roll_up(metric.denominator_metric)
+    return metric.aggregate_method in ADDITIVE_AGGREGATE_METHODS or metric.aggregate_method == AggregateMethod.APPROX_DISTINCT
+
+
+def get_single_column_metrics(metrics: List[Metric]) -> List[SingleColumnMetric]:
+    return flatten([
+        [metric.numerator_metric, metric.denominator_metric] if isinstance(metric, DualColumnMetric) else [metric] for metric in metrics
+    ])
+
+
+def get_cube_column(metric: SingleColumnMetric) -> str:
+    """The cube column of the metric, which only depends on what is aggregated so that it is shared by metrics of any name."""
+    return dataclasses.replace(metric, name=None).get_id()
+
+
+def build_daily_cube(df: pl.LazyFrame, dimensions: List[str], metrics: List[SingleColumnMetric]) -> pl.DataFrame:
+    """
+    Aggregate the rows by date and dimensions, the metric columns are named by get_cube_column. Approximate distinct counts
+    are kept as their sketches.
+    """
+    aggregation_expressions = {
+        get_cube_column(metric): (
+            build_distinct_sketch(metric.get_column_expr()) if metric.aggregate_method == AggregateMethod.APPROX_DISTINCT
+            else metric.get_aggregation_exprs()[0]
+        ).alias(get_cube_column(metric))
+        for metric in metrics
+    }
+    return df.groupby(["date"] + dimensions) \
+        .agg(list(aggregation_expressions.values()) + [pl.count("date").alias("count")]) \
+        .sort("date") \
+        .collect() \
+        .with_columns(pl.col("date").set_sorted())
+
+
+def has_cube_columns(cube_df: pl.DataFrame, metrics: List[SingleColumnMetric]) -> bool:
+    return all(get_cube_column(metric) in cube_df.columns for metric in metrics)
+
+
+def select_cube_metrics(cube_df: pl.DataFrame, dimensions: List[str], metrics: List[Metric]) -> DailyCube:
+    """The cube of the metrics, out of a cube which may hold the columns of further metrics."""
+    metric_columns = {metric.get_id(): get_cube_column(metric) for metric in get_single_column_metrics(metrics)}
+    return DailyCube(cube_df.select(
+        ["date"] + dimensions + [pl.col(cube_column).alias(metric_id) for metric_id, cube_column in metric_columns.items()] + ["count"]
+    ))
+
+
+def _roll_up(metric: SingleColumnMetric) -> pl.Expr:
+    if metric.aggregate_method == AggregateMethod.APPROX_DISTINCT:
+        return estimate_distinct_count(merge_distinct_sketches(pl.col(metric.get_id()))).alias(metric.get_id())
+    return pl.col(metric.get_id()).sum()
+
+
+def get_rollup_exprs(metric: Metric) -> List[pl.Expr]:
+    """The counterpart of Metric.get_aggregation_exprs over the rows of a daily cube."""
+    if isinstance(metric, DualColumnMetric):
+        numerator_expr = _roll_up(metric.numerator_metric)
+        denominator_expr = _roll_up(metric.denominator_metric)
+        return [
+            numerator_expr,
+            denominator_expr,
+            pl.when((denominator_expr == 0) | numerator_expr.is_null() | denominator_expr.is_null())
+            .then(0)
+            .otherwise(numerator_expr / denominator_expr)
+            .alias(metric.get_id())
+        ]
+    return [_roll_up(metric)]
+
+
+def build_rollup_expressions(metrics: List[Metric]) -> List[pl.Expr]:
+    """The counterpart of build_aggregation_expressions over the rows of a daily cube."""
+    return flatten([get_rollup_exprs(metric) for metric in metrics]) + [pl.col("count").sum()]
@@ -1,9 +1,10 @@
 import datetime
-from concurrent.futures import wait
+import time
+from dataclasses import dataclass
+from enum import StrEnum
 from itertools import combinations
-from typing import List, Optional, Tuple
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 
-import numpy
 import numpy as np
 import orjson
 import polars as polars
@@ -12,26 +13,198 @@ from polars import Expr
 from scipy import stats
 
 from app.common.errors import EmptyDataFrameError
-from app.insight.services.metrics import (Dimension, DimensionValuePair,
-                                          DualColumnMetric, Metric,
-                                          MetricInsight, PeriodValue,
-                                          SegmentInfo, SingleColumnMetric,
-                                          flatten, parallel_analysis_executor, Filter)
-from app.insight.services.utils import build_aggregation_expressions, get_filter_expression, get_num_rows
+from app.insight.services.analysis_executor import AnalysisExecutor, AnalysisExecutorType
+from app.insight.services.cube import aggregate_segment_children, build_cube, build_pruned_cube, get_cube_columns
+from app.insight.services.daily_cube import DailyCube, build_rollup_expressions, get_rollup_exprs
+from app.insight.services.metrics import (Dimension, DualColumnMetric, Metric,
+                                          MetricInsight, SingleColumnMetric,
+                                          flatten, Filter)
+from app.insight.services.sampling import SamplingOptions, build_interval_expr, build_standard_error_expressions, build_variance_expressions, \
+    can_sample, get_sample_expression, get_variance_columns, scale_sampled_columns
+from app.insight.services.segment_table import limit_segments
+from app.insight.services.sketches import build_distinct_sketch, get_sketch_column, get_sketched_metrics, merge_distinct_sketches
+from app.insight.services.utils import DateSortedFile, build_aggregation_expressions, encode_dimension_columns, get_filter_expression, \
+    iter_rows_by_key, select_date_range, signed_value_expr
+
+
+def _safe_divide(n: Expr, m: Expr):
+    return polars.when(m == 0).then(0).otherwise(n / m)
+
+
+@dataclass
+class SegmentAnalysisContext:
+    metrics: List[Metric]
+    analyzing_metric: Metric
+    expected_value: float
+    overall_values: Dict[str, float]
+    # Total weight of the joined table, the weight of the segments of a combination only adds up to it if none were pruned
+    weight_sums: Tuple[float, float]
+    # The sampling fraction of sampled insights, whose segments get the standard errors of their change and absolute contribution
+    sampling_fraction: Optional[float] = None
+
+
+def analyze_column_combination(aggregated_df: polars.DataFrame, columns: List[str], context: SegmentAnalysisContext) -> polars.DataFrame:
+    """Score the segments of one dimension combination from its aggregated cube, this runs in the workers of the analysis executor."""
+    metric_columns = flatten([
+        ([polars.col(metric.get_id()), polars.col(f"{metric.get_id()}_baseline")] if isinstance(metric, SingleColumnMetric) else [
+            _safe_divide(polars.col(metric.numerator_metric.get_id()), polars.col(metric.denominator_metric.get_id())).alias(metric.get_id()),
+            polars.col(metric.numerator_metric.get_id()),
+            polars.col(metric.denominator_metric.get_id()),
+
+            _safe_divide(polars.col(f"{metric.numerator_metric.get_id()}_baseline"), polars.col(f"{metric.denominator_metric.get_id()}_baseline")).alias(
+                f"{metric.get_id()}_baseline"),
+            polars.col(f"{metric.numerator_metric.get_id()}_baseline"),
+            polars.col(f"{metric.denominator_metric.get_id()}_baseline")
+        ])
+        for metric in context.metrics
+    ]) + [polars.col("count"), polars.col("count_baseline")]
+    if context.sampling_fraction is not None:
+        metric_columns += flatten([[polars.col(column), polars.col(f"{column}_baseline")] for column in get_variance_columns(context.metrics)])
+
+    joined = aggregated_df.select(
+        metric_columns + [
+            polars.lit([columns], dtype=polars.List).alias("dimension_name"),
+            polars.concat_list([polars.col(column) for column in columns]).alias("dimension_value")
+        ]
+    )
+
+    analyzing_metric = context.analyzing_metric
+    weight_col_name = analyzing_metric.get_weight_column_name()
+    weight_sum, baseline_weight_sum = context.weight_sums
+
+    joined = joined \
+        .with_columns((polars.lit(weight_sum) + polars.lit(baseline_weight_sum)).alias("sum")) \
+        .with_columns((polars.col(weight_col_name) + polars.col(f"{weight_col_name}_baseline")).alias("weight"),
+                      polars.when(
+                          polars.col(
+                              f"{analyzing_metric.get_id()}_baseline") == 0
+                      ).then(
+                          polars.when(
+                              polars.col(analyzing_metric.get_id()) > 0
+                          ).then(polars.lit(1)).otherwise(polars.lit(-1))
+                      ).otherwise(
+                          (polars.col(analyzing_metric.get_id()) - polars.col(f"{analyzing_metric.get_id()}_baseline")) / polars.col(
+                              f"{analyzing_metric.get_id()}_baseline")
+                      ).alias("change")
+                      ) \
+        .with_columns((polars.col("change") - polars.lit(context.expected_value)).alias("calibrated_change")) \
+        .with_columns((polars.col("weight") * polars.col("calibrated_change")).alias("weighted_change"))
+
+    weighted_change_mean = joined.select(
+        polars.col("weighted_change").sum() / polars.col("weight").sum()).row(0)
+    weighted_relative_change_std = (joined.select(
+        ((polars.col("weight") * (polars.col("change") - polars.lit(weighted_change_mean)).pow(2)).sum() / polars.col("weight").sum()).sqrt()
+    )).row(0)
+    res = joined.with_columns(polars.lit(weighted_relative_change_std).alias("weighted_relative_change_std"))
+
+    if isinstance(analyzing_metric, SingleColumnMetric):
+        sum = context.overall_values[analyzing_metric.get_id()]
+        sum_baseline = context.overall_values[f"{analyzing_metric.get_id()}_baseline"]
+
+        overall_change = _safe_divide(polars.lit(sum) - polars.lit(sum_baseline), polars.lit(sum_baseline))
+        overall_change_without_segment = _safe_divide(
+            (polars.lit(sum) - polars.col(analyzing_metric.get_id())) - (
+                    polars.lit(sum_baseline) - polars.col(f"{analyzing_metric.get_id()}_baseline")),
+            polars.lit(sum_baseline) - polars.col(f"{analyzing_metric.get_id()}_baseline")
+        )
+
+        res = res.with_columns((overall_change - overall_change_without_segment).alias("absolute_contribution"))
+
+    elif isinstance(analyzing_metric, DualColumnMetric):
+        numerator_id = analyzing_metric.numerator_metric.get_id()
+        denominator_id = analyzing_metric.denominator_metric.get_id()
+
+        numerator_sum = context.overall_values[numerator_id]
+        numerator_sum_baseline = context.overall_values[f"{numerator_id}_baseline"]
+        denominator_sum = context.overall_values[denominator_id]
+        denominator_sum_baseline = context.overall_values[f"{denominator_id}_baseline"]
+
+        overall_ratio_change = _safe_divide(polars.lit(numerator_sum), polars.lit(denominator_sum)) - _safe_divide(polars.lit(numerator_sum_baseline),
+                                                                                                                   polars.lit(denominator_sum_baseline))
+
+        overall_ratio_change_without_segment = _safe_divide(polars.lit(numerator_sum) - polars.col(numerator_id),
+                                                            polars.lit(denominator_sum) - polars.col(denominator_id)) - _safe_divide(
+            polars.lit(numerator_sum_baseline) - polars.col(f"{numerator_id}_baseline"), polars.lit(denominator_sum_baseline) - polars.col(
+                f"{denominator_id}_baseline"))
+
+        res = res.with_columns((overall_ratio_change - overall_ratio_change_without_segment).alias("absolute_contribution"))
+
+    if context.sampling_fraction is not None:
+        res = res.with_columns(build_standard_error_expressions(analyzing_metric, context.overall_values, context.sampling_fraction))
+    return res
+
+
+default_analysis_executor = AnalysisExecutor(AnalysisExecutorType.THREAD)
+
+TOP_SEGMENT_MIN_SUPPORT = 0.01
+
+# Number of segments serialized per chunk of a streamed response
+SEGMENT_BATCH_SIZE = 2000
+
+MAX_EXHAUSTIVE_DIMENSIONS = 3
+MAX_BEAM_SEARCH_DIMENSIONS = 5
+
+
+class InsightStage(StrEnum):
+    """The stages of building insights, in order. The builder reports the ones between loading and serializing the data."""
+    LOAD = "load"
+    FILTER = "filter"
+    GROUP_BY = "group_by"
+    SEGMENT_ANALYSIS = "segment_analysis"
+    SERIALIZATION = "serialization"
+
+
+@dataclass
+class SegmentAnalysis:
+    """The scored segments of one analyzing metric, shared by the insights of the metric and of its numerator and denominator."""
+    segments_df: polars.DataFrame
+    dimensions: List[Dimension]
+    key_dimensions: List[str]
+    total_segments: int
+
+
+@dataclass
+class BeamSearchOptions:
+    """Budgets of the search for segments with more dimensions than the exhaustively analyzed combinations."""
+    width: int = 20
+    max_segments: int = 5000
+    time_budget_seconds: float = 10
 
 
 class DFBasedInsightBuilder(object):
     def __init__(self,
-                 data: polars.DataFrame,
+                 data: polars.DataFrame | polars.LazyFrame | DateSortedFile | DailyCube,
                  baseline_date_range: Tuple[datetime.date, datetime.date],
                  comparison_date_range: Tuple[datetime.date, datetime.date],
                  group_by_columns: List[str],
                  metrics: List[Metric],
                  expected_value: float,
                  filters: list[Filter] = None,
-                 max_num_dimensions: int = 3
+                 max_num_dimensions: int = 3,
+                 analysis_executor: AnalysisExecutor = None,
+                 min_segment_support: Optional[float] = None,
+                 beam_search_options: BeamSearchOptions = None,
+                 sampling_options: Optional[SamplingOptions] = None,
+                 on_stage: Optional[Callable[[InsightStage], None]] = None
                  ):
-        self.df = data
+        """
+        The data is always processed as a lazy frame so that only the aggregated results are materialized. Passing in a lazy
+        frame scanned from a file additionally pushes the column projection, filters and group-bys down to the file reader.
+        Passing in a daily cube of additive metrics sums up its rows of the date ranges instead of aggregating the raw rows.
+
+        With min_segment_support set, multi dimension segments covering less than this share of the rows are pruned before
+        the next level of combinations is aggregated.
+
+        Combinations of up to three dimensions are analyzed exhaustively. Segments with up to five dimensions are explored
+        with a beam search, only extending the segments with the largest absolute contribution of the previous level.
+
+        With sampling_options set, the raw rows of the date ranges are sampled and the sums are scaled up from the sample, and
+        the segments get confidence intervals for their change and absolute contribution. Daily cubes and metrics which can not
+        be estimated from a sample are always analyzed exactly.
+
+        on_stage is called with the current stage whenever the build reaches a stage or a step within one, an exception raised
+        by it aborts the build.
+        """
         self.group_by_columns = group_by_columns
         self.group_by_columns.sort()
         self.metrics = metrics
@@ -40,77 +213,145 @@ class DFBasedInsightBuilder(object):
         self.comparison_date_range = comparison_date_range
 
         self.expected_value = expected_value
+        self.analysis_executor = analysis_executor if analysis_executor is not None else default_analysis_executor
+        self.min_segment_support = min_segment_support
+        self.beam_search_options = beam_search_options if beam_search_options is not None else BeamSearchOptions()
 
-        self.segments_df = polars.DataFrame()
-        self.key_dimensions = []
-        self.analyzing_metric = self.metrics[0]
-
-        logger.info('init')
-        self.df = self.df.filter(get_filter_expression(filters))
+        self.segment_analyses: Dict[str, SegmentAnalysis] = {}
+        self.segment_info_dfs: Dict[str, polars.DataFrame] = {}
+        self.metric_insights: Optional[List[Tuple[Metric, MetricInsight]]] = None
+        self.on_stage = on_stage
 
-        if get_num_rows(self.df) == 0:
-            raise EmptyDataFrameError()
+        if sampling_options is not None and (isinstance(data, DailyCube) or not all(can_sample(metric) for metric in self.metrics)):
+            logger.info('Not sampling, the metrics are aggregated exactly')
+            sampling_options = None
+        self.sampling_options = sampling_options
+        self.variance_columns = get_variance_columns(self.metrics) if self.sampling_options is not None else []
 
-        self.baseline_df = self.df.filter(
-            polars.col('date').is_between(
-                polars.lit(self.baseline_date_range[0]),
-                polars.lit(self.baseline_date_range[1])
-            )
-        )
-        self.comparison_df = self.df.filter(
-            polars.col('date').is_between(
-                polars.lit(self.comparison_date_range[0]),
-                polars.lit(self.comparison_date_range[1])
-            )
-        )
-        self.aggregation_expressions = build_aggregation_expressions(self.metrics)
-        self.overall_aggregated_df = self.gen_agg_df()
-
-        if max_num_dimensions > 3:
-            self.max_num_dimensions = 3
+        logger.info('init')
+        self.enter_stage(InsightStage.FILTER)
+        # The approximate distinct counts of the finest segments are kept along with their sketches, which the cube merges
+        if isinstance(data, DailyCube):
+            self.metric_aggregation_expressions = flatten([get_rollup_exprs(metric) for metric in self.metrics])
+            self.aggregation_expressions = build_rollup_expressions(self.metrics)
+            self.sketch_expressions = [
+                merge_distinct_sketches(polars.col(metric.get_id())).alias(get_sketch_column(metric.get_id()))
+                for metric in get_sketched_metrics(self.metrics)
+            ]
+            data = data.df
+        else:
+            self.metric_aggregation_expressions = flatten([metric.get_aggregation_exprs() for metric in self.metrics])
+            self.aggregation_expressions = build_aggregation_expressions(self.metrics)
+            self.sketch_expressions = [
+                build_distinct_sketch(metric.get_column_expr()).alias(get_sketch_column(metric.get_id()))
+                for metric in get_sketched_metrics(self.metrics)
+            ]
+
+        filter_expression = get_filter_expression(filters)
+        self.df = data.lazy().filter(filter_expression)
+
+        # Frames sorted by date are sliced to the date ranges before being filtered
+        self.baseline_df = select_date_range(data, self.baseline_date_range).lazy().filter(filter_expression)
+        self.comparison_df = select_date_range(data, self.comparison_date_range).lazy().filter(filter_expression)
+        if self.sampling_options is not None:
+            logger.info(f'Sampling {self.sampling_options.fraction} of the rows')
+            # The samples are small, they are collected once instead of being drawn again by every aggregation
+            self.baseline_df, self.comparison_df = [
+                sample_df.lazy() for sample_df in polars.collect_all([
+                    self.baseline_df.filter(get_sample_expression(self.sampling_options)),
+                    self.comparison_df.filter(get_sample_expression(self.sampling_options))
+                ])
+            ]
+            self.aggregation_expressions = self.aggregation_expressions + build_variance_expressions(self.metrics)
+
+        if max_num_dimensions > MAX_BEAM_SEARCH_DIMENSIONS:
+            self.max_num_dimensions = MAX_BEAM_SEARCH_DIMENSIONS
         elif max_num_dimensions < 1:
             self.max_num_dimensions = 1
         else:
             self.max_num_dimensions = max_num_dimensions
 
         column_combinations_list = []
-        for i in range(1, min(self.max_num_dimensions, len(self.group_by_columns)) + 1):
+        for i in range(1, min(self.max_num_dimensions, MAX_EXHAUSTIVE_DIMENSIONS, len(self.group_by_columns)) + 1):
             column_combinations_list.extend(
                 combinations(self.group_by_columns, i))
 
-        baseline_df = self.baseline_df.groupby(self.group_by_columns).agg(self.aggregation_expressions)
-        comparison_df = self.comparison_df.groupby(self.group_by_columns).agg(self.aggregation_expressions)
+        logger.info('Aggregating data')
+        self.enter_stage(InsightStage.GROUP_BY)
+        (
+            num_rows_df,
+            baseline_overall_df,
+            comparison_overall_df,
+            self.baseline_value_by_date_df,
+            self.comparison_value_by_date_df,
+            baseline_df,
+            comparison_df
+        ) = polars.collect_all([
+            self.df.select(polars.count()),
+            self.baseline_df.select(self.aggregation_expressions),
+            self.comparison_df.select(self.aggregation_expressions),
+            self.gen_value_by_date_df(self.baseline_df),
+            self.gen_value_by_date_df(self.comparison_df),
+            self.baseline_df.groupby(self.group_by_columns).agg(self.aggregation_expressions + self.sketch_expressions),
+            self.comparison_df.groupby(self.group_by_columns).agg(self.aggregation_expressions + self.sketch_expressions)
+        ])
+
+        if num_rows_df.item(0, 0) == 0:
+            raise EmptyDataFrameError()
+
+        if self.sampling_options is not None:
+            fraction = self.sampling_options.fraction
+            baseline_overall_df = scale_sampled_columns(baseline_overall_df, self.metrics, fraction)
+            comparison_overall_df = scale_sampled_columns(comparison_overall_df, self.metrics, fraction)
+            self.baseline_value_by_date_df = scale_sampled_columns(self.baseline_value_by_date_df, self.metrics, fraction)
+            self.comparison_value_by_date_df = scale_sampled_columns(self.comparison_value_by_date_df, self.metrics, fraction)
+            baseline_df = scale_sampled_columns(baseline_df, self.metrics, fraction)
+            comparison_df = scale_sampled_columns(comparison_df, self.metrics, fraction)
 
+        self.overall_aggregated_df = comparison_overall_df.join(baseline_overall_df, suffix='_baseline', how='cross').fill_nan(0).fill_null(0)
         self.joined_df = comparison_df.join(
             baseline_df,
             on=self.group_by_columns,
             suffix="_baseline",
             how='outer'
         ).fill_null(0).fill_nan(0)
-        self.segments_df, self.dimensions, self.total_segments = self.analyze_segments(column_combinations_list)
-        self.key_dimensions = [dimension.name for dimension in self.dimensions if dimension.is_key_dimension]
+        # The segment analysis only works on the codes of the dimension values, the values are decoded for the final segments
+        self.joined_df, self.dimension_dictionary_df = encode_dimension_columns(self.joined_df, self.group_by_columns)
+
+        # The cube only holds sums, so it is shared by the segment scoring of all metrics
+        self.enter_stage(InsightStage.SEGMENT_ANALYSIS)
+        min_count = None
+        if self.min_segment_support is not None:
+            min_count = self.min_segment_support * (self.overall_aggregated_df['count_baseline'].sum() + self.overall_aggregated_df['count'].sum())
+            cube = build_pruned_cube(self.joined_df, column_combinations_list, self.metrics, min_count, self.analysis_executor, self.variance_columns)
+        else:
+            cube = build_cube(self.joined_df, column_combinations_list, self.metrics, self.analysis_executor, self.variance_columns)
+        for metric in self.metrics:
+            self.enter_stage(InsightStage.SEGMENT_ANALYSIS)
+            self.segment_analyses[metric.get_id()] = self.analyze_segments(metric, cube, column_combinations_list, min_count)
         logger.info('init done')
 
-    def gen_agg_df(self):
-        baseline = self.baseline_df.select(self.aggregation_expressions)
-        comparison = self.comparison_df.select(self.aggregation_expressions)
+    def enter_stage(self, stage: InsightStage):
+        if self.on_stage is not None:
+            self.on_stage(stage)
 
-        return comparison.join(baseline, suffix='_baseline', how='cross').fill_nan(0).fill_null(0)
-
-    def gen_value_by_date(self, df: polars.DataFrame, metric: Metric):
-        aggregated_df = df.groupby('date').agg(metric.get_aggregation_exprs()) \
+    def gen_value_by_date_df(self, df: polars.LazyFrame) -> polars.LazyFrame:
+        return df.groupby('date').agg(self.metric_aggregation_expressions) \
             .sort('date') \
             .with_columns(polars.col('date').cast(polars.Utf8))
 
+    @staticmethod
+    def gen_value_by_date(aggregated_df: polars.DataFrame, metric: Metric):
         return [
             {
                 "date": row['date'],
                 "value": row[metric.get_id()]
             }
-            for row in aggregated_df.rows(named=True)
+            for row in aggregated_df.select('date', metric.get_id()).rows(named=True)
         ]
 
-    def build_metric_insight(self, metric: Metric, parent_metric: Optional[Metric] = None) -> MetricInsight:
+    def build_metric_insight(self, metric: Metric, parent_metric: Optional[Metric] = None) -> Tuple[MetricInsight, polars.DataFrame]:
+        """Build the insight without its dimension slice info, which is returned as a data frame to be serialized in batches."""
         insight = MetricInsight()
         insight.id = metric.get_id()
         insight.name = metric.get_display_name()
@@ -118,15 +359,16 @@ class DFBasedInsightBuilder(object):
             metric, SingleColumnMetric) else None
         insight.baselineNumRows = self.overall_aggregated_df['count_baseline'].sum()
         insight.comparisonNumRows = self.overall_aggregated_df['count'].sum()
-        insight.dimensions = {dimension.name: dimension for dimension in self.dimensions}
-        insight.totalSegments = self.total_segments
-        insight.keyDimensions = self.key_dimensions
+        segment_analysis = self.segment_analyses[(parent_metric if parent_metric is not None else metric).get_id()]
+        insight.dimensions = {dimension.name: dimension for dimension in segment_analysis.dimensions}
+        insight.totalSegments = segment_analysis.total_segments
+        insight.keyDimensions = segment_analysis.key_dimensions
 
         # Build dimension slice info
         logger.info(f'Building dimension slice info for {metric.get_id()}')
 
-        insight.dimensionSliceInfo, insight.topDriverSliceKeys = self.convert_to_segment_info(
-            self.segments_df, metric, insight.baselineNumRows, insight.comparisonNumRows, parent_metric)
+        segment_info_df, insight.topDriverSliceKeys = self.convert_to_segment_info(
+            segment_analysis, metric, insight.baselineNumRows, insight.comparisonNumRows, parent_metric)
 
         insight.baselineValue = self.overall_aggregated_df[f'{metric.get_id()}_baseline'].sum()
         insight.comparisonValue = self.overall_aggregated_df[metric.get_id()].sum()
@@ -135,10 +377,12 @@ class DFBasedInsightBuilder(object):
 
         insight.aggregationMethod = metric.get_metric_type()
         insight.expectedChangePercentage = self.expected_value
+        insight.isSampled = self.sampling_options is not None
+        insight.samplingFraction = self.sampling_options.fraction if self.sampling_options is not None else None
         insight.baselineValueByDate = self.gen_value_by_date(
-            self.baseline_df, metric)
+            self.baseline_value_by_date_df, metric)
         insight.comparisonValueByDate = self.gen_value_by_date(
-            self.comparison_df, metric)
+            self.comparison_value_by_date_df, metric)
 
         insight.baselineDateRange = [self.baseline_date_range[0].strftime(
             "%Y-%m-%d"), self.baseline_date_range[1].strftime("%Y-%m-%d")]
@@ -147,120 +391,108 @@ class DFBasedInsightBuilder(object):
 
         logger.info('Finished building metrics')
 
-        return insight
-
-    def build(self) -> str:
+        return insight, segment_info_df
 
-        metrics_to_build = [(metric, None) for metric in self.metrics] + flatten(
+    def get_metrics_to_build(self) -> List[Tuple[Metric, Optional[Metric]]]:
+        """The analyzed metrics, followed by the numerators and denominators of the ratio metrics along with their ratio."""
+        return [(metric, None) for metric in self.metrics] + flatten(
             [[(metric.numerator_metric, metric), (metric.denominator_metric, metric)] for metric in self.metrics if
              isinstance(metric, DualColumnMetric)])
-        metric_ids = [metric.get_id() for metric, _ in metrics_to_build]
-        logger.info(f'Building metrics for {metric_ids}')
-        ret = {
-            metric.get_id(): self.build_metric_insight(metric, parent_metric)
-            for metric, parent_metric in metrics_to_build
-        }
-
-        logger.info(f'Finished building metrics for {metric_ids}')
-        ret = orjson.dumps(ret)
+
+    def build_metric_insights(self) -> List[Tuple[Metric, MetricInsight]]:
+        """
+        Build the insight and the segment table of every metric to build, once. Callers streaming the insights build them
+        ahead of the response, so that a failure is reported as an error instead of truncating a response already sent.
+        """
+        if self.metric_insights is None:
+            metric_insights = []
+            for metric, parent_metric in self.get_metrics_to_build():
+                insight, self.segment_info_dfs[metric.get_id()] = self.build_metric_insight(metric, parent_metric)
+                metric_insights.append((metric, insight))
+            self.metric_insights = metric_insights
+        return self.metric_insights
+
+    def build_chunks(self, max_num_segments: Optional[int] = None) -> Iterator[bytes]:
+        """
+        Serialize the insights chunk by chunk, one metric at a time and one batch of segments at a time, so that neither the
+        segments as python objects nor the whole response have to be held in memory.
+
+        With max_num_segments, only the top segments by sort value and the top driver segments are serialized. The full
+        segment table of every metric is kept in segment_info_dfs so that further segments can be served page by page.
+        """
+        metric_insights = self.build_metric_insights()
+        metric_ids = [metric.get_id() for metric, _ in metric_insights]
+        logger.info(f'Dumping metrics for {metric_ids}')
+
+        yield b"{"
+        for i, (metric, insight) in enumerate(metric_insights):
+            segment_info_df = self.segment_info_dfs[metric.get_id()]
+            insight_fields = {field: value for field, value in vars(insight).items() if field != "dimensionSliceInfo"}
+
+            yield (b"," if i > 0 else b"") + orjson.dumps(metric.get_id()) + b":" + orjson.dumps(insight_fields)[:-1] + b',"dimensionSliceInfo":'
+            yield from iter_rows_by_key(
+                limit_segments(segment_info_df, max_num_segments, insight.topDriverSliceKeys), "serializedKey", SEGMENT_BATCH_SIZE
+            )
+            yield b"}"
+        yield b"}"
+
         logger.info(f'Finished dumping metrics for {metric_ids}')
-        return ret
-
-    def analyze_segments(self, column_combinations_list: List[List[str]]):
-        def _safe_divide(n: Expr, m: Expr):
-            return polars.when(m == 0).then(0).otherwise(n / m)
-
-        sub_df_agg_methods_alt = flatten([
-            ([polars.sum(metric.get_id()), polars.sum(f"{metric.get_id()}_baseline")] if isinstance(metric, SingleColumnMetric) else [
-                _safe_divide(polars.sum(metric.numerator_metric.get_id()), polars.sum(metric.denominator_metric.get_id())).alias(metric.get_id()),
-                polars.sum(metric.numerator_metric.get_id()).alias(metric.numerator_metric.get_id()),
-                polars.sum(metric.denominator_metric.get_id()).alias(metric.denominator_metric.get_id()),
-
-                _safe_divide(polars.sum(f"{metric.numerator_metric.get_id()}_baseline"), polars.sum(f"{metric.denominator_metric.get_id()}_baseline")).alias(
-                    f"{metric.get_id()}_baseline"),
-                polars.sum(f"{metric.numerator_metric.get_id()}_baseline").alias(f"{metric.numerator_metric.get_id()}_baseline"),
-                polars.sum(f"{metric.denominator_metric.get_id()}_baseline").alias(f"{metric.denominator_metric.get_id()}_baseline")
-            ])
-            for metric in self.metrics
-        ]) + [polars.sum("count").alias("count"), polars.sum("count_baseline").alias("count_baseline")]
-
-        def gen_sub_df_for_columns(columns: List[str]):
-            joined = self.joined_df \
-                .groupby(columns) \
-                .agg(sub_df_agg_methods_alt) \
-                .with_columns(polars.lit([columns], dtype=polars.List).alias("dimension_name")) \
-                .with_columns(polars.concat_list([polars.col(column).cast(str) for column in columns]).alias("dimension_value")) \
-                .drop(columns)
-
-            analyzing_metric = next(iter(self.metrics))
-            weight_col_name = analyzing_metric.get_weight_column_name()
-            weight_sum, baseline_weight_sum = joined.select((polars.col(
-                weight_col_name, f"{weight_col_name}_baseline").sum())).row(0)
-
-            joined = joined \
-                .with_columns((polars.lit(weight_sum) + polars.lit(baseline_weight_sum)).alias("sum")) \
-                .with_columns((polars.col(weight_col_name) + polars.col(f"{weight_col_name}_baseline")).alias("weight"),
-                              polars.when(
-                                  polars.col(
-                                      f"{analyzing_metric.get_id()}_baseline") == 0
-                              ).then(
-                                  polars.when(
-                                      polars.col(analyzing_metric.get_id()) > 0
-                                  ).then(polars.lit(1)).otherwise(polars.lit(-1))
-                              ).otherwise(
-                                  (polars.col(analyzing_metric.get_id()) - polars.col(f"{analyzing_metric.get_id()}_baseline")) / polars.col(
-                                      f"{analyzing_metric.get_id()}_baseline")
-                              ).alias("change")
-                              ) \
-                .with_columns((polars.col("change") - polars.lit(self.expected_value)).alias("calibrated_change")) \
-                .with_columns((polars.col("weight") * polars.col("calibrated_change")).alias("weighted_change"))
-
-            weighted_change_mean = joined.select(
-                polars.col("weighted_change").sum() / polars.col("weight").sum()).row(0)
-            weighted_relative_change_std = (joined.select(
-                ((polars.col("weight") * (polars.col("change") - polars.lit(weighted_change_mean)).pow(2)).sum() / polars.col("weight").sum()).sqrt()
-            )).row(0)
-            res = joined.with_columns(polars.lit(weighted_relative_change_std).alias("weighted_relative_change_std"))
-
-            if isinstance(analyzing_metric, SingleColumnMetric):
-                sum = self.overall_aggregated_df[analyzing_metric.get_id()].sum()
-                sum_baseline = self.overall_aggregated_df[f"{analyzing_metric.get_id()}_baseline"].sum()
-
-                overall_change = _safe_divide(polars.lit(sum) - polars.lit(sum_baseline), polars.lit(sum_baseline))
-                overall_change_without_segment = _safe_divide(
-                    (polars.lit(sum) - polars.col(analyzing_metric.get_id())) - (
-                            polars.lit(sum_baseline) - polars.col(f"{analyzing_metric.get_id()}_baseline")),
-                    polars.lit(sum_baseline) - polars.col(f"{analyzing_metric.get_id()}_baseline")
-                )
-
-                return res.with_columns((overall_change - overall_change_without_segment).alias("absolute_contribution"))
-
-            elif isinstance(analyzing_metric, DualColumnMetric):
-                numerator_id = analyzing_metric.numerator_metric.get_id()
-                denominator_id = analyzing_metric.denominator_metric.get_id()
-
-                numerator_sum = self.overall_aggregated_df[numerator_id].sum()
-                numerator_sum_baseline = self.overall_aggregated_df[f"{numerator_id}_baseline"].sum()
-                denominator_sum = self.overall_aggregated_df[denominator_id].sum()
-                denominator_sum_baseline = self.overall_aggregated_df[f"{denominator_id}_baseline"].sum()
-
-                overall_ratio_change = _safe_divide(polars.lit(numerator_sum), polars.lit(denominator_sum)) - _safe_divide(polars.lit(numerator_sum_baseline),
-                                                                                                                           polars.lit(denominator_sum_baseline))
-
-                overall_ratio_change_without_segment = _safe_divide(polars.lit(numerator_sum) - polars.col(numerator_id),
-                                                                    polars.lit(denominator_sum) - polars.col(denominator_id)) - _safe_divide(
-                    polars.lit(numerator_sum_baseline) - polars.col(f"{numerator_id}_baseline"), polars.lit(denominator_sum_baseline) - polars.col(
-                        f"{denominator_id}_baseline"))
-
-                return res.with_columns((overall_ratio_change - overall_ratio_change_without_segment).alias("absolute_contribution"))
-            return res
-
-        futures = [parallel_analysis_executor.submit(
-            gen_sub_df_for_columns, columns
-        ) for columns in column_combinations_list]
-        wait(futures)
-
-        multi_dimension_grouping_result = polars.concat([future.result() for future in futures])
+
+    def build_tables(self, max_num_segments: Optional[int] = None) -> Iterator[Tuple[polars.DataFrame, Dict[str, str]]]:
+        """
+        The insights as frames for the binary response format, each with its metadata: per metric the segment table, with
+        the other fields of the insight as json in its metadata, followed by the baseline and comparison value by date.
+        """
+        for metric, insight in self.build_metric_insights():
+            segment_info_df = self.segment_info_dfs[metric.get_id()]
+            insight_fields = {
+                field: value for field, value in vars(insight).items()
+                if field not in ["dimensionSliceInfo", "baselineValueByDate", "comparisonValueByDate"]
+            }
+
+            yield limit_segments(segment_info_df, max_num_segments, insight.topDriverSliceKeys), {
+                "table": "dimensionSliceInfo",
+                "metricId": metric.get_id(),
+                "insight": orjson.dumps(insight_fields).decode()
+            }
+            for table, value_by_date_df in [
+                ("baselineValueByDate", self.baseline_value_by_date_df),
+                ("comparisonValueByDate", self.comparison_value_by_date_df)
+            ]:
+                yield value_by_date_df.select("date", polars.col(metric.get_id()).alias("value")), {"table": table, "metricId": metric.get_id()}
+
+    def build_segment_info_dfs(self) -> Dict[str, polars.DataFrame]:
+        """The segment table of every metric, without serializing the insights."""
+        self.build_metric_insights()
+        return self.segment_info_dfs
+
+    def build(self) -> bytes:
+        return b"".join(self.build_chunks())
+
+    def analyze_segments(
+            self,
+            analyzing_metric: Metric,
+            cube: Dict[Tuple[str, ...], polars.DataFrame],
+            column_combinations_list: List[List[str]],
+            min_count: Optional[float]
+    ) -> SegmentAnalysis:
+        weight_col_name = analyzing_metric.get_weight_column_name()
+        context = SegmentAnalysisContext(
+            self.metrics,
+            analyzing_metric,
+            self.expected_value,
+            self.overall_aggregated_df.sum().row(0, named=True),
+            self.joined_df.select(polars.col(weight_col_name, f"{weight_col_name}_baseline").sum()).row(0),
+            self.sampling_options.fraction if self.sampling_options is not None else None
+        )
+        # Pruning leaves the combinations without candidates empty, they have no segments and empty frames with list columns do
+        # not survive the pickling to worker processes with their schema
+        multi_dimension_grouping_result = polars.concat(self.analysis_executor.map(
+            analyze_column_combination,
+            [(cube[tuple(columns)], list(columns), context) for columns in column_combinations_list if cube[tuple(columns)].height > 0]
+        ))
+        if self.max_num_dimensions > MAX_EXHAUSTIVE_DIMENSIONS and len(self.group_by_columns) > MAX_EXHAUSTIVE_DIMENSIONS:
+            multi_dimension_grouping_result = self.expand_segments_with_beam_search(multi_dimension_grouping_result, context, min_count)
 
         dimension_info_df = multi_dimension_grouping_result.filter(polars.col("dimension_name").list.lengths() == 1) \
             .with_columns(polars.col("dimension_name").list.first()) \
@@ -281,11 +513,11 @@ class DFBasedInsightBuilder(object):
 
         total_segments = multi_dimension_grouping_result.select(polars.col("dimension_name").count().alias("total_segments")).row(0)[0]
 
-        if isinstance(self.analyzing_metric, DualColumnMetric):
-            sort_column = (polars.col(self.analyzing_metric.numerator_metric.get_id()) - polars.col(
-                f"{self.analyzing_metric.numerator_metric.get_id()}_baseline")).abs().alias("sort")
+        if isinstance(analyzing_metric, DualColumnMetric):
+            sort_column = (polars.col(analyzing_metric.numerator_metric.get_id()) - polars.col(
+                f"{analyzing_metric.numerator_metric.get_id()}_baseline")).abs().alias("sort")
         else:
-            sort_column = (polars.col(self.analyzing_metric.get_id()) - polars.col(f"{self.analyzing_metric.get_id()}_baseline")).abs().alias("sort")
+            sort_column = (polars.col(analyzing_metric.get_id()) - polars.col(f"{analyzing_metric.get_id()}_baseline")).abs().alias("sort")
         change_variance_column = polars.when(polars.col('weighted_std') != 0).then(
             (polars.col('change') - polars.lit(self.expected_value)).abs() / polars.col('weighted_std') * (polars.col('weight') / polars.col('sum')).sqrt()) \
             .otherwise(0) \
@@ -301,90 +533,200 @@ class DFBasedInsightBuilder(object):
             .limit(20000) \
             .sort([polars.col("sort").abs()], descending=True)
 
-        return multi_dimension_grouping_result, dimensions, total_segments
+        return SegmentAnalysis(
+            self.with_segment_key_columns(multi_dimension_grouping_result),
+            dimensions,
+            [dimension.name for dimension in dimensions if dimension.is_key_dimension],
+            total_segments
+        )
+
+    def expand_segments_with_beam_search(self, segments_df: polars.DataFrame, context: SegmentAnalysisContext, min_count: Optional[float]) -> polars.DataFrame:
+        """
+        Extend the segments with the largest absolute contribution by one more dimension at a time, until the max number of
+        dimensions or one of the budgets is reached. The children of all kept parents are aggregated per combination.
+
+        The segment budget is split evenly over the levels left, every level keeping the children with the largest absolute
+        contribution within its share so that a wide level does not starve the levels after it.
+        """
+        options = self.beam_search_options
+        cube_columns = get_cube_columns(self.metrics, self.variance_columns)
+        start_time = time.time()
+        num_new_segments = 0
+        level_df = segments_df.filter(polars.col("dimension_name").list.lengths() == MAX_EXHAUSTIVE_DIMENSIONS)
+        results = [segments_df]
+
+        def is_out_of_time() -> bool:
+            return time.time() - start_time > options.time_budget_seconds
+
+        for num_dimensions in range(MAX_EXHAUSTIVE_DIMENSIONS + 1, self.max_num_dimensions + 1):
+            self.enter_stage(InsightStage.SEGMENT_ANALYSIS)
+            if is_out_of_time() or num_new_segments >= options.max_segments:
+                logger.info(f"Stopping the beam search before {num_dimensions} dimensions, the budget is used up")
+                break
+
+            parents = level_df.sort(polars.col("absolute_contribution").abs(), descending=True) \
+                .limit(options.width) \
+                .select("dimension_name", "dimension_value") \
+                .rows()
+            parents_by_combination = {}
+            for dimension_name, dimension_value in parents:
+                for column in self.group_by_columns:
+                    if column not in dimension_name:
+                        parents_by_combination.setdefault(tuple(sorted(dimension_name + [column])), []).append((dimension_name, dimension_value))
+
+            if len(parents_by_combination) == 0:
+                break
+
+            logger.info(f"Beam search over {len(parents_by_combination)} combinations with {num_dimensions} dimensions")
+            aggregated_dfs = self.analysis_executor.map_frame(
+                aggregate_segment_children, self.joined_df, list(parents_by_combination.items()), (cube_columns, min_count)
+            )
+            if is_out_of_time():
+                logger.info(f"Stopping the beam search at {num_dimensions} dimensions, the time budget is used up")
+                break
+
+            analysis_args = [
+                (aggregated_df, list(columns), context)
+                for aggregated_df, columns in zip(aggregated_dfs, parents_by_combination.keys()) if aggregated_df.height > 0
+            ]
+            if len(analysis_args) == 0:
+                break
+
+            level_df = polars.concat(self.analysis_executor.map(analyze_column_combination, analysis_args))
+            num_levels_left = self.max_num_dimensions - num_dimensions + 1
+            level_budget = (options.max_segments - num_new_segments) // num_levels_left
+            if level_df.height > level_budget:
+                logger.info(f"Keeping {level_budget} of {level_df.height} segments with {num_dimensions} dimensions")
+                level_df = level_df.sort(polars.col("absolute_contribution").abs(), descending=True).limit(level_budget)
+
+            num_new_segments += level_df.height
+            results.append(level_df)
+
+        return polars.concat(results)
+
+    def with_segment_key_columns(self, df: polars.DataFrame) -> polars.DataFrame:
+        """
+        Decode the dimension values of the segments, and add the serialized key and the list of dimension value pairs of every
+        segment, built in one exploded pass. The codes are kept as dimension_codes.
+        """
+        keys_df = df.select("dimension_name", "dimension_value") \
+            .with_row_count("segment_index") \
+            .explode(["dimension_name", "dimension_value"]) \
+            .join(self.dimension_dictionary_df, left_on=["dimension_name", "dimension_value"], right_on=["dimension_name", "code"], how="left") \
+            .groupby("segment_index", maintain_order=True) \
+            .agg(
+                polars.col("value").alias("dimension_value"),
+                polars.concat_str([polars.col("dimension_name"), polars.lit(":"), polars.col("value").fill_null("None")]).alias("serialized_key"),
+                polars.struct([polars.col("dimension_name").alias("dimension"), polars.col("value").fill_null("None").alias("value")]).alias("key")
+            ) \
+            .with_columns(polars.col("serialized_key").list.join("|"))
+
+        return df.with_columns(
+            polars.col("dimension_value").alias("dimension_codes"),
+            keys_df["dimension_value"],
+            keys_df["serialized_key"],
+            keys_df["key"]
+        )
+
+    def calculate_p_values(self, segments_df: polars.DataFrame, metric: Metric) -> polars.DataFrame:
+        """
+        Run the t-test of the change of every segment at once. The per segment sample size, mean and variance of the change
+        are calculated with one join of the segment codes with the joined table per dimension combination, then the p-values
+        are evaluated vectorized over all segments.
+        """
+        value = polars.col(metric.get_id()).cast(polars.Float64)
+        baseline_value = polars.col(f"{metric.get_id()}_baseline").cast(polars.Float64)
+        if isinstance(metric, DualColumnMetric):
+            diff = value - baseline_value
+        else:
+            diff = (value - baseline_value) / baseline_value * 100
+        valid_diff = diff.filter(diff.is_finite())
+
+        combination_column = polars.col("dimension_name").list.join("|")
+        column_combinations = segments_df.select(combination_column.unique())["dimension_name"].to_list()
+
+        stats_df = polars.concat([
+            segments_df.filter(combination_column == combination)
+            .select(
+                polars.col("serialized_key"),
+                *[polars.col("dimension_codes").list.get(i).alias(column) for i, column in enumerate(combination.split("|"))]
+            )
+            .join(self.joined_df, on=combination.split("|"), how="inner")
+            .groupby("serialized_key")
+            .agg(
+                polars.count().alias("num_rows"),
+                valid_diff.count().cast(polars.Int64).alias("n"),
+                valid_diff.mean().alias("mean"),
+                valid_diff.std(ddof=1).alias("std")
+            )
+            for combination in column_combinations
+        ]) if len(column_combinations) > 0 else polars.DataFrame(
+            schema={"serialized_key": polars.Utf8, "num_rows": polars.UInt32, "n": polars.Int64, "mean": polars.Float64, "std": polars.Float64}
+        )
+
+        n = stats_df["n"].to_numpy().astype(np.float64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t_statistic = stats_df["mean"].to_numpy() / (stats_df["std"].to_numpy() / np.sqrt(n))
+            p_value = 2 * (1 - stats.t.cdf(np.abs(t_statistic), df=n - 1))
+        p_value = np.where(n > stats_df["num_rows"].to_numpy() / 2, p_value, -1)
+
+        return polars.DataFrame({
+            "serialized_key": stats_df["serialized_key"],
+            "confidence": polars.Series(p_value, dtype=polars.Float64)
+        })
 
     def convert_to_segment_info(
             self,
-            df: polars.DataFrame,
+            segment_analysis: SegmentAnalysis,
             metric: Metric,
             baseline_count: int,
             comparison_count: int,
             parent_metric: Optional[Metric] = None
     ):
-        def _build_serialized_key(row):
-            return "|".join([f"{column}:{value}" for column, value in zip(row['dimension_name'], row['dimension_value'])])
-
-        if len(self.key_dimensions) > 0:
+        df = segment_analysis.segments_df
+        if len(segment_analysis.key_dimensions) > 0:
             total_rows = self.overall_aggregated_df['count_baseline'].sum() + self.overall_aggregated_df['count'].sum()
 
-            top_segments_df = df.with_columns(polars.concat_list([polars.lit(dimension) for dimension in self.key_dimensions]).alias("key_dimensions")) \
-                .filter((polars.col("count") + polars.col("count_baseline")) / polars.lit(total_rows) > 0.01) \
+            top_segments_df = df.with_columns(polars.concat_list([polars.lit(dimension) for dimension in segment_analysis.key_dimensions]).alias("key_dimensions")) \
+                .filter((polars.col("count") + polars.col("count_baseline")) / polars.lit(total_rows) > TOP_SEGMENT_MIN_SUPPORT) \
                 .filter(polars.col("dimension_name").list.set_intersection("key_dimensions").list.lengths() == polars.col("dimension_name").list.lengths()) \
                 .limit(1000)
-            top_segment_keys = [_build_serialized_key(row) for row in top_segments_df.rows(named=True)]
+            top_segment_keys = top_segments_df["serialized_key"].to_list()
         else:
+            top_segments_df = df.clear()
             top_segment_keys = []
 
-        def map_to_segment_info(row):
-            values = row["dimension_value"]
-            dimensions = row['dimension_name']
-            key = tuple([DimensionValuePair(dimensions[i], str(values[i]))
-                         for i in range(len(dimensions))])
-            serialized_key = _build_serialized_key(row)
-
-            current_period_value = PeriodValue(
-                row['count'], 0 if comparison_count == 0 else row['count'] / comparison_count, row[metric.get_id()])
-            last_period_value = PeriodValue(
-                row['count_baseline'], 0 if baseline_count == 0 else row['count_baseline'] / baseline_count,
-                row[f'{metric.get_id()}_baseline'])
-
-            p_value = -1
-            if parent_metric is None and serialized_key in top_segment_keys:
-                filters = polars.lit(True)
-                for column, value in zip(row['dimension_name'], row['dimension_value']):
-                    filters = filters & polars.col(column).cast(polars.Utf8).eq(value)
-                filtered_joined_df = self.joined_df.filter(filters)
-
-                value_list = filtered_joined_df[f"{metric.get_id()}"]
-                value_list_baseline = filtered_joined_df[f"{metric.get_id()}_baseline"]
-
-                if value_list is not None and value_list_baseline is not None:
-                    value_list = numpy.array(value_list)
-                    value_list_baseline = numpy.array(value_list_baseline)
-
-                    if isinstance(metric, DualColumnMetric):
-                        diff = value_list - value_list_baseline
-                    else:
-                        relative_diff = ((value_list - value_list_baseline) / value_list_baseline) * 100
-                        relative_diff = relative_diff[~np.isinf(relative_diff)]
-                        relative_diff = relative_diff[~np.isnan(relative_diff)]
-                        diff = relative_diff
-
-                    if len(diff) > len(value_list) / 2:
-                        mean_diff = np.mean(diff)
-                        std_diff = np.std(diff, ddof=1)
-
-                        n = len(diff)
-
-                        standard_error = std_diff / np.sqrt(n)
-                        t_statistic = mean_diff / standard_error
-                        p_value = 2 * (1 - stats.t.cdf(abs(t_statistic), df=n - 1))
-
-            slice_info = SegmentInfo(
-                key,
-                serialized_key,
-                last_period_value,
-                current_period_value,
-                current_period_value.sliceValue - last_period_value.sliceValue,
-                row['change'],
-                row['change_variance'],
-                row['absolute_contribution'],
-                float(p_value),
-                row['sort']
-            )
-
-            return slice_info.serializedKey, slice_info
+        if parent_metric is None:
+            confidence_df = self.calculate_p_values(top_segments_df, metric)
+        else:
+            confidence_df = polars.DataFrame(schema={"serialized_key": polars.Utf8, "confidence": polars.Float64})
+
+        def _slice_size(count_column: str, total_count: int) -> Expr:
+            return polars.lit(0) if total_count == 0 else polars.col(count_column) / polars.lit(total_count)
+
+        segments_df = df.join(confidence_df, on="serialized_key", how="left").select(
+            polars.col("key"),
+            polars.col("serialized_key").alias("serializedKey"),
+            polars.struct([
+                polars.col("count_baseline").alias("sliceCount"),
+                _slice_size("count_baseline", baseline_count).alias("sliceSize"),
+                polars.col(f"{metric.get_id()}_baseline").alias("sliceValue")
+            ]).alias("baselineValue"),
+            polars.struct([
+                polars.col("count").alias("sliceCount"),
+                _slice_size("count", comparison_count).alias("sliceSize"),
+                polars.col(metric.get_id()).alias("sliceValue")
+            ]).alias("comparisonValue"),
+            (signed_value_expr(df, metric.get_id()) - signed_value_expr(df, f"{metric.get_id()}_baseline")).alias("impact"),
+            polars.col("change").alias("changePercentage"),
+            polars.col("change_variance").alias("changeDev"),
+            polars.col("absolute_contribution").alias("absoluteContribution"),
+            polars.col("confidence").fill_null(-1.0),
+            polars.col("sort").alias("sortValue"),
+            *([
+                build_interval_expr("change", "change_std_error").alias("changePercentageInterval"),
+                build_interval_expr("absolute_contribution", "absolute_contribution_std_error").alias("absoluteContributionInterval")
+            ] if self.sampling_options is not None else [])
+        )
 
-        segments = [map_to_segment_info(row) for row in df.rows(named=True)]
-        segments_dict = {serialized_key: segment for serialized_key, segment in segments}
-        return segments_dict, list(top_segment_keys)
+        return segments_df, top_segment_keys
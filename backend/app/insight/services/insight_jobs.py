@@ -0,0 +1,142 @@
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from enum import StrEnum
+from threading import Lock
+from typing import Callable, Optional
+
+from loguru import logger
+
+from app.common.errors import EmptyDataFrameError, JobCancelledError
+from app.insight.services.insight_builders import InsightStage
+
+# Builds the insights of a job, reporting its stages to the callback, and returns the result cache key of the insights
+InsightJobTask = Callable[[Callable[[InsightStage], None]], str]
+
+
+class InsightJobStatus(StrEnum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+@dataclass
+class InsightJob:
+    id: str
+    submitted_at: float
+    status: InsightJobStatus = InsightJobStatus.QUEUED
+    stage: Optional[InsightStage] = None
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    result_key: Optional[str] = None
+    error: Optional[str] = None
+    cancel_requested: bool = False
+    future: Optional[Future] = field(default=None, repr=False)
+
+    def is_finished(self) -> bool:
+        return self.status in [InsightJobStatus.SUCCEEDED, InsightJobStatus.FAILED, InsightJobStatus.CANCELLED]
+
+    def to_json(self) -> dict:
+        """The state of the job as returned when polling it, the progress is the share of the stages passed."""
+        stages = list(InsightStage)
+        if self.status == InsightJobStatus.SUCCEEDED:
+            progress = 1.0
+        elif self.stage is not None:
+            progress = stages.index(self.stage) / len(stages)
+        else:
+            progress = 0.0
+
+        end = self.finished_at if self.finished_at is not None else time.time()
+        return {
+            "jobId": self.id,
+            "status": self.status,
+            "stage": self.stage,
+            "stages": stages,
+            "progress": progress,
+            "elapsedSeconds": end - self.started_at if self.started_at is not None else 0,
+            "error": self.error
+        }
+
+
+class InsightJobManager:
+    """
+    Runs insight builds on a bounded pool of worker threads so that they do not block the requests which submit and poll
+    them. Only the state of the most recent jobs is kept, the results themselves live in the result cache.
+
+    Cancelling a queued job drops it, a running job stops at the next stage or step it reports since a running polars query
+    can not be interrupted.
+    """
+
+    def __init__(self, max_workers: int, history_size: int):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="insight-job")
+        self.history_size = history_size
+        self.jobs: OrderedDict[str, InsightJob] = OrderedDict()
+        self.lock = Lock()
+
+    def submit(self, task: InsightJobTask) -> InsightJob:
+        job = InsightJob(uuid.uuid4().hex, time.time())
+        with self.lock:
+            self.jobs[job.id] = job
+            self.evict()
+        job.future = self.executor.submit(self.run, job, task)
+        return job
+
+    def evict(self):
+        """Forget the oldest finished jobs beyond the history size, jobs which did not finish yet are always kept."""
+        finished_job_ids = [job_id for job_id, job in self.jobs.items() if job.is_finished()]
+        for job_id in finished_job_ids[:max(0, len(self.jobs) - self.history_size)]:
+            del self.jobs[job_id]
+
+    def get(self, job_id: str) -> Optional[InsightJob]:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> Optional[InsightJob]:
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.is_finished():
+                return job
+            job.cancel_requested = True
+            if job.future is not None and job.future.cancel():
+                self.finish(job, InsightJobStatus.CANCELLED)
+            return job
+
+    def finish(self, job: InsightJob, status: InsightJobStatus, error: Optional[str] = None):
+        job.status = status
+        job.error = error
+        job.finished_at = time.time()
+
+    def enter_stage(self, job: InsightJob, stage: InsightStage):
+        if job.cancel_requested:
+            raise JobCancelledError()
+        job.stage = stage
+
+    def run(self, job: InsightJob, task: InsightJobTask):
+        with self.lock:
+            if job.cancel_requested:
+                self.finish(job, InsightJobStatus.CANCELLED)
+                return
+            job.status = InsightJobStatus.RUNNING
+            job.started_at = time.time()
+
+        logger.info(f"Running insight job {job.id}")
+        try:
+            result_key = task(lambda stage: self.enter_stage(job, stage))
+            with self.lock:
+                job.result_key = result_key
+                self.finish(job, InsightJobStatus.SUCCEEDED)
+        except JobCancelledError:
+            logger.info(f"Cancelled insight job {job.id} at stage {job.stage}")
+            with self.lock:
+                self.finish(job, InsightJobStatus.CANCELLED)
+        except EmptyDataFrameError:
+            with self.lock:
+                self.finish(job, InsightJobStatus.FAILED, "EMPTY_DATASET")
+        except Exception as e:
+            logger.exception(e)
+            with self.lock:
+                self.finish(job, InsightJobStatus.FAILED, str(e))
@@ -2,7 +2,6 @@ import hashlib
 import itertools
 import json
 from abc import ABC, abstractmethod
-from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import date
 from enum import Enum, StrEnum
@@ -83,6 +82,8 @@ class AggregateMethod(Enum):
     COUNT = 1
     DISTINCT = 2
     SUM = 3
+    # Distinct count estimated from mergeable sketches, see app.insight.services.sketches
+    APPROX_DISTINCT = 4
 
 
 class CombineMethod(Enum):
@@ -115,6 +116,10 @@ class Metric(ABC):
     def get_sorting_expr(self) -> Expr:
         pass
 
+    @abstractmethod
+    def get_columns(self) -> List[str]:
+        pass
+
 
 @dataclass
 class SingleColumnMetric(Metric):
@@ -143,13 +148,17 @@ class SingleColumnMetric(Metric):
 
         return f"{self.aggregate_method.name} {self.column}"
 
-    def get_aggregation_exprs(self, agg_override: Optional[AggregateMethod] = None) -> Iterable[Expr]:
+    def get_column_expr(self) -> Expr:
+        """The values of the column in the rows matching the filters of the metric."""
         from app.insight.services.utils import get_filter_expression
 
         col = pl.col(self.column)
         if len(self.filters) > 0:
             col = pl.col(self.column).filter(get_filter_expression(self.filters))
-        return [build_polars_agg(col, agg_override if agg_override is not None else self.aggregate_method).alias(self.get_id())]
+        return col
+
+    def get_aggregation_exprs(self, agg_override: Optional[AggregateMethod] = None) -> Iterable[Expr]:
+        return [build_polars_agg(self.get_column_expr(), agg_override if agg_override is not None else self.aggregate_method).alias(self.get_id())]
 
     def get_metric_type(self):
         return self.aggregate_method.name
@@ -160,6 +169,9 @@ class SingleColumnMetric(Metric):
     def get_sorting_expr(self) -> Expr:
         return (pl.col(self.get_id()) - pl.col(f"{self.get_id()}_baseline")).abs().alias("sort")
 
+    def get_columns(self) -> List[str]:
+        return [self.column] + [filter.column for filter in self.filters]
+
 
 @dataclass
 class DualColumnMetric(Metric):
@@ -202,6 +214,9 @@ class DualColumnMetric(Metric):
     def get_sorting_expr(self) -> Expr:
         return (pl.col(self.numerator_metric.get_id()) - pl.col(f"{self.numerator_metric.get_id()}_baseline")).abs().alias("sort")
 
+    def get_columns(self) -> List[str]:
+        return self.numerator_metric.get_columns() + self.denominator_metric.get_columns()
+
 
 @dataclass
 class MetricInsight:
@@ -222,9 +237,8 @@ class MetricInsight:
     dimensionSliceInfo: Dict[str, SegmentInfo] = None
     keyDimensions: List[str] = None
     filters: Dict[str, any] = None
-
-
-parallel_analysis_executor = ThreadPoolExecutor()
+    isSampled: bool = False
+    samplingFraction: Optional[float] = None
 
 
 def build_polars_agg(name: str | Expr, method: AggregateMethod):
@@ -237,6 +251,10 @@ def build_polars_agg(name: str | Expr, method: AggregateMethod):
         return col.count()
     elif method == AggregateMethod.DISTINCT:
         return col.n_unique().cast(int)
+    elif method == AggregateMethod.APPROX_DISTINCT:
+        from app.insight.services.sketches import build_distinct_sketch, estimate_distinct_count
+
+        return estimate_distinct_count(build_distinct_sketch(col))
 
 
 class NpEncoder(json.JSONEncoder):
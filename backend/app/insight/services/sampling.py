@@ -0,0 +1,210 @@
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+import polars as pl
+from polars import Expr
+
+from app.insight.services.metrics import AggregateMethod, DualColumnMetric, Metric, SingleColumnMetric, flatten
+
+# Sampled insights keep every row with the probability of the sampling fraction and scale the sums of the kept rows up by its
+# inverse. The variance of such a scaled sum is estimated by (1 - fraction) / fraction times the scaled sum of the squared
+# row values, from which the variance of the change and the absolute contribution of a segment follows with the delta method.
+# The intervals are normal approximations at this confidence, so they are only meaningful for segments with enough rows.
+SAMPLING_CONFIDENCE_Z = 1.96
+SAMPLING_HASH_SEED = 0
+# Only sums can be scaled up from a sample, distinct counts of a sample say little about the distinct count of all rows
+SAMPLED_AGGREGATE_METHODS = [AggregateMethod.SUM, AggregateMethod.COUNT]
+
+
+@dataclass
+class SamplingOptions:
+    """
+    Analyze a sample of the rows with the fraction of them. The sample is stratified by date if requested, keeping the same
+    share of the rows of every day so that the value by date series does not get noisier on days with few rows.
+    """
+    fraction: float
+    stratify_by_date: bool = False
+
+
+def can_sample(metric: Metric) -> bool:
+    if isinstance(metric, DualColumnMetric):
+        return can_sample(metric.numerator_metric) and can_sample(metric.denominator_metric)
+    return metric.aggregate_method in SAMPLED_AGGREGATE_METHODS
+
+
+def get_sample_expression(options: SamplingOptions) -> Expr:
+    """The rows of the sample, picked by a hash of the row index so that the same request gets the same sample."""
+    row_hash = pl.int_range(0, pl.count()).hash(SAMPLING_HASH_SEED)
+    if options.stratify_by_date:
+        return row_hash.rank("ordinal").over("date") <= (pl.count().over("date") * options.fraction).ceil()
+    return row_hash.cast(pl.Float64) / 2.0 ** 64 < options.fraction
+
+
+def get_square_column(metric: SingleColumnMetric) -> str:
+    return f"{metric.get_id()}_squares"
+
+
+def get_cross_column(metric: DualColumnMetric) -> str:
+    return f"{metric.get_id()}_cross_products"
+
+
+def _get_row_value_expr(metric: SingleColumnMetric) -> Expr:
+    """What every row adds to the aggregated value of the metric, zero for the rows not matching the filters of the metric."""
+    from app.insight.services.utils import get_filter_expression
+
+    value = pl.col(metric.column).cast(pl.Float64) if metric.aggregate_method == AggregateMethod.SUM \
+        else pl.col(metric.column).is_not_null().cast(pl.Float64)
+    if len(metric.filters) > 0:
+        value = pl.when(get_filter_expression(metric.filters)).then(value).otherwise(0)
+    return value.fill_null(0)
+
+
+def _get_squared_metrics(metrics: List[Metric]) -> List[SingleColumnMetric]:
+    return list({
+        metric.get_id(): metric for metric in flatten([
+            [metric.numerator_metric, metric.denominator_metric] if isinstance(metric, DualColumnMetric) else [metric] for metric in metrics
+        ])
+    }.values())
+
+
+def build_variance_expressions(metrics: List[Metric]) -> List[Expr]:
+    """The sums of the squared row values of every metric and of the products of the numerator and denominator of ratios."""
+    return [
+        _get_row_value_expr(metric).pow(2).sum().alias(get_square_column(metric)) for metric in _get_squared_metrics(metrics)
+    ] + [
+        (_get_row_value_expr(metric.numerator_metric) * _get_row_value_expr(metric.denominator_metric)).sum().alias(get_cross_column(metric))
+        for metric in metrics if isinstance(metric, DualColumnMetric)
+    ]
+
+
+def get_variance_columns(metrics: List[Metric]) -> List[str]:
+    return [get_square_column(metric) for metric in _get_squared_metrics(metrics)] + [
+        get_cross_column(metric) for metric in metrics if isinstance(metric, DualColumnMetric)
+    ]
+
+
+def scale_sampled_columns(df: pl.DataFrame, metrics: List[Metric], fraction: float) -> pl.DataFrame:
+    """Scale the sums over the sample up to estimates of the sums over all rows, the ratios do not change."""
+    value_columns = [metric.get_id() for metric in _get_squared_metrics(metrics)] + get_variance_columns(metrics)
+    scaled_columns = [pl.col(column) / fraction for column in value_columns if column in df.columns]
+    if "count" in df.columns:
+        scaled_columns.append((pl.col("count") / fraction).round(0).cast(pl.Int64))
+    return df.with_columns(scaled_columns)
+
+
+@dataclass
+class _Totals:
+    """
+    The estimated numerator and denominator of a metric over a group of rows, along with the sums of squares and cross
+    products their variance is estimated from. Single column metrics have no denominator.
+    """
+    numerator: Expr
+    numerator_squares: Expr
+    denominator: Optional[Expr] = None
+    cross_products: Optional[Expr] = None
+    denominator_squares: Optional[Expr] = None
+
+    def value(self) -> Expr:
+        return self.numerator if self.denominator is None else self.numerator / self.denominator
+
+    def gradient(self) -> Tuple[Expr, Expr]:
+        """The partial derivatives of the value by the numerator and by the denominator."""
+        if self.denominator is None:
+            return pl.lit(1.0), pl.lit(0.0)
+        return 1 / self.denominator, -self.numerator / self.denominator.pow(2)
+
+    def get_variance(self, numerator_coefficient: Expr, denominator_coefficient: Expr, fraction: float) -> Expr:
+        """The variance of the sum of the numerator and denominator values of the rows weighted by the coefficients."""
+        variance = numerator_coefficient.pow(2) * self.numerator_squares
+        if self.denominator is not None:
+            variance = variance + 2 * numerator_coefficient * denominator_coefficient * self.cross_products \
+                       + denominator_coefficient.pow(2) * self.denominator_squares
+        return (1 - fraction) / fraction * variance
+
+    def __sub__(self, other: "_Totals") -> "_Totals":
+        if self.denominator is None:
+            return _Totals(self.numerator - other.numerator, self.numerator_squares - other.numerator_squares)
+        return _Totals(
+            self.numerator - other.numerator,
+            self.numerator_squares - other.numerator_squares,
+            self.denominator - other.denominator,
+            self.cross_products - other.cross_products,
+            self.denominator_squares - other.denominator_squares
+        )
+
+
+def _get_totals(metric: Metric, column: Callable[[str], Expr], suffix: str) -> _Totals:
+    if isinstance(metric, DualColumnMetric):
+        return _Totals(
+            column(f"{metric.numerator_metric.get_id()}{suffix}"),
+            column(f"{get_square_column(metric.numerator_metric)}{suffix}"),
+            column(f"{metric.denominator_metric.get_id()}{suffix}"),
+            column(f"{get_cross_column(metric)}{suffix}"),
+            column(f"{get_square_column(metric.denominator_metric)}{suffix}")
+        )
+    return _Totals(column(f"{metric.get_id()}{suffix}"), column(f"{get_square_column(metric)}{suffix}"))
+
+
+def _get_period_variance(
+        overall_derivative: Expr, overall: _Totals, rest_derivative: Expr, rest: _Totals, segment: _Totals, fraction: float
+) -> Expr:
+    """
+    The variance of a function of the value over all rows and the value over the rows outside of the segment, in one period.
+    The rows of the segment only move the former, the other rows move both.
+    """
+    overall_numerator, overall_denominator = overall.gradient()
+    rest_numerator, rest_denominator = rest.gradient()
+    return segment.get_variance(overall_derivative * overall_numerator, overall_derivative * overall_denominator, fraction) + rest.get_variance(
+        overall_derivative * overall_numerator + rest_derivative * rest_numerator,
+        overall_derivative * overall_denominator + rest_derivative * rest_denominator,
+        fraction
+    )
+
+
+def _standard_error(variance: Expr) -> Expr:
+    return pl.when(variance.is_finite() & (variance >= 0)).then(variance.sqrt()).otherwise(None)
+
+
+def build_standard_error_expressions(metric: Metric, overall_values: Dict[str, float], fraction: float) -> List[Expr]:
+    """
+    The standard errors of the change and of the absolute contribution of the segments in a cube of the sampled rows, as the
+    change_std_error and absolute_contribution_std_error columns. The periods are sampled independently, so their variances
+    add up.
+    """
+    segment = _get_totals(metric, pl.col, "")
+    segment_baseline = _get_totals(metric, pl.col, "_baseline")
+    overall = _get_totals(metric, lambda column: pl.lit(overall_values[column]), "")
+    overall_baseline = _get_totals(metric, lambda column: pl.lit(overall_values[column]), "_baseline")
+    rest = overall - segment
+    rest_baseline = overall_baseline - segment_baseline
+
+    # The change is the ratio of the values of the segment in the two periods
+    numerator, denominator = segment.gradient()
+    baseline_numerator, baseline_denominator = segment_baseline.gradient()
+    change_derivative = 1 / segment_baseline.value()
+    baseline_change_derivative = -segment.value() / segment_baseline.value().pow(2)
+    change_variance = segment.get_variance(change_derivative * numerator, change_derivative * denominator, fraction) \
+        + segment_baseline.get_variance(baseline_change_derivative * baseline_numerator, baseline_change_derivative * baseline_denominator, fraction)
+
+    # The absolute contribution is the overall change minus the change without the segment, relative for single column
+    # metrics and absolute for ratios
+    if isinstance(metric, DualColumnMetric):
+        overall_derivatives = pl.lit(1.0), pl.lit(-1.0)
+        rest_derivatives = pl.lit(-1.0), pl.lit(1.0)
+    else:
+        overall_derivatives = 1 / overall_baseline.value(), -overall.value() / overall_baseline.value().pow(2)
+        rest_derivatives = -1 / rest_baseline.value(), rest.value() / rest_baseline.value().pow(2)
+    absolute_contribution_variance = \
+        _get_period_variance(overall_derivatives[0], overall, rest_derivatives[0], rest, segment, fraction) \
+        + _get_period_variance(overall_derivatives[1], overall_baseline, rest_derivatives[1], rest_baseline, segment_baseline, fraction)
+
+    return [
+        _standard_error(change_variance).alias("change_std_error"),
+        _standard_error(absolute_contribution_variance).alias("absolute_contribution_std_error")
+    ]
+
+
+def build_interval_expr(column: str, std_error_column: str) -> Expr:
+    """The confidence interval around the value of the column as a [low, high] list, missing if it could not be estimated."""
+    margin = pl.col(std_error_column) * SAMPLING_CONFIDENCE_Z
+    return pl.when(margin.is_not_null()).then(pl.concat_list([pl.col(column) - margin, pl.col(column) + margin])).otherwise(None)
@@ -1,11 +1,13 @@
 from dataclasses import dataclass
 from datetime import datetime
-from typing import List, Tuple
+from typing import Dict, List, Tuple
 
 import polars as pl
 
+from app.insight.services.daily_cube import DailyCube, get_rollup_exprs
 from app.insight.services.metrics import Metric, ValueByDate, flatten, DualColumnMetric, DimensionValuePair, PeriodValue, SegmentInfo, Filter
-from app.insight.services.utils import build_base_df, prepare_joined_df, get_filter_expression
+from app.insight.services.utils import build_aggregation_expressions, build_base_df, prepare_joined_df, get_filter_expression, \
+    select_date_range, signed_value_expr
 
 
 @dataclass
@@ -16,23 +18,21 @@ class TimeSeriesInsight:
 
 
 def get_segment_insight(
-        df: pl.DataFrame,
+        df: pl.DataFrame | DailyCube,
         date_column: str,
         baseline_date_range: Tuple[datetime.date, datetime.date],
         comparison_date_range: Tuple[datetime.date, datetime.date],
         metrics: List[Metric],
         filters: list[Filter]):
+    if isinstance(df, DailyCube):
+        aggs = flatten([get_rollup_exprs(metric) for metric in metrics])
+        df = df.df
+    else:
+        aggs = flatten([metric.get_aggregation_exprs() for metric in metrics])
     df = df.filter(get_filter_expression(filters))
-    aggs = flatten([metric.get_aggregation_exprs() for metric in metrics])
-    baseline = df.filter(pl.col('date').is_between(
-        pl.lit(baseline_date_range[0]),
-        pl.lit(baseline_date_range[1])
-    )).groupby('date').agg(aggs).sort('date').with_columns(pl.col('date').cast(pl.Utf8))
+    baseline = select_date_range(df, baseline_date_range).groupby('date').agg(aggs).sort('date').with_columns(pl.col('date').cast(pl.Utf8))
 
-    comparison = df.filter(pl.col('date').is_between(
-        pl.lit(comparison_date_range[0]),
-        pl.lit(comparison_date_range[1])
-    )).groupby('date').agg(aggs).sort('date').with_columns(pl.col('date').cast(pl.Utf8))
+    comparison = select_date_range(df, comparison_date_range).groupby('date').agg(aggs).sort('date').with_columns(pl.col('date').cast(pl.Utf8))
 
     metrics = metrics + flatten([[metric.numerator_metric, metric.denominator_metric] for metric in metrics if
                                  isinstance(metric, DualColumnMetric)])
@@ -55,14 +55,15 @@ def get_segment_insight(
     ) for metric in metrics]
 
 
-def get_related_segments(
+def build_related_segments_joined_df(
         df: pl.DataFrame,
         baseline_date_range: Tuple[datetime.date, datetime.date],
         comparison_date_range: Tuple[datetime.date, datetime.date],
         segment_key: list[DimensionValuePair],
         metric: Metric,
         filters: list[Filter]
-):
+) -> Tuple[pl.DataFrame, int, int]:
+    """The segments over the dimensions of the segment key, along with the baseline and comparison row counts."""
     df = df.filter(get_filter_expression(filters))
     dimensions = [segment_key_part.dimension for segment_key_part in segment_key]
 
@@ -72,7 +73,19 @@ def get_related_segments(
     comparison = build_base_df(df, comparison_date_range, dimensions, [metric])
     comparison_count = comparison.select(pl.col("count").sum()).row(0)[0]
 
-    joined = prepare_joined_df(baseline, comparison, dimensions, [metric])
+    return prepare_joined_df(baseline, comparison, dimensions, [metric]), baseline_count, comparison_count
+
+
+def get_related_segments(
+        df: pl.DataFrame,
+        baseline_date_range: Tuple[datetime.date, datetime.date],
+        comparison_date_range: Tuple[datetime.date, datetime.date],
+        segment_key: list[DimensionValuePair],
+        metric: Metric,
+        filters: list[Filter]
+):
+    joined, baseline_count, comparison_count = build_related_segments_joined_df(
+        df, baseline_date_range, comparison_date_range, segment_key, metric, filters)
 
     if isinstance(metric, DualColumnMetric):
         return {
@@ -88,41 +101,81 @@ def get_related_segments(
         }
 
 
-def get_waterfall_insight(
+def get_related_segment_dfs(
         df: pl.DataFrame,
         baseline_date_range: Tuple[datetime.date, datetime.date],
         comparison_date_range: Tuple[datetime.date, datetime.date],
-        segment_keys: list[list[DimensionValuePair]],
+        segment_key: list[DimensionValuePair],
         metric: Metric,
-        filters: list[Filter],
-):
-    df = df.filter(get_filter_expression(filters))
+        filters: list[Filter]
+) -> Dict[str, pl.DataFrame]:
+    """The related segments as one frame per metric with the columns of SegmentInfo, without building the python objects."""
+    joined, baseline_count, comparison_count = build_related_segments_joined_df(
+        df, baseline_date_range, comparison_date_range, segment_key, metric, filters)
+    dimensions = [segment_key_part.dimension for segment_key_part in segment_key]
 
-    result = {}
-    for segment_key in segment_keys:
+    metrics = [metric] + ([metric.numerator_metric, metric.denominator_metric] if isinstance(metric, DualColumnMetric) else [])
+    return {
+        current_metric.get_id(): map_to_segment_info_df(joined, dimensions, baseline_count, comparison_count, current_metric)
+        for current_metric in metrics
+    }
+
+
+def label_waterfall_segments(df: pl.DataFrame, segment_keys: list[list[DimensionValuePair]]) -> pl.DataFrame:
+    """The rows of the frame along with the index of the first segment containing them, leaving out rows in no segment."""
+    labeled_dfs = []
+    for index, segment_key in enumerate(segment_keys):
         filtering_clause = pl.lit(True)
         for sub_key in segment_key:
             filtering_clause = filtering_clause & (pl.col(
                 sub_key.dimension).cast(str).eq(pl.lit(sub_key.value)))
 
-        current_df = df.filter(filtering_clause)
+        labeled_dfs.append(df.filter(filtering_clause).with_columns(pl.lit(index, dtype=pl.UInt32).alias("waterfall_segment")))
+        df = df.filter(filtering_clause.is_not())
 
-        dimensions = [sub_key.dimension for sub_key in segment_key]
-        baseline_df = build_base_df(current_df, baseline_date_range, dimensions, [metric])
-        baseline_value = baseline_df.row(0, named=True)[metric.get_id()] if len(baseline_df.rows()) > 0 else 0
+    return pl.concat(labeled_dfs)
 
-        comparison_df = build_base_df(current_df, comparison_date_range, dimensions, [metric])
-        comparison_value = comparison_df.row(0, named=True)[metric.get_id()] if len(comparison_df.rows()) > 0 else 0
 
+def get_waterfall_insight(
+        df: pl.DataFrame,
+        baseline_date_range: Tuple[datetime.date, datetime.date],
+        comparison_date_range: Tuple[datetime.date, datetime.date],
+        segment_keys: list[list[DimensionValuePair]],
+        metric: Metric,
+        filters: list[Filter],
+):
+    """
+    The change of the metric in each segment, leaving out the rows of the segments before it. Instead of filtering all the
+    rows once per segment, the segments are assigned to the distinct combinations of the dimension values, which are far
+    fewer than the rows. The rows are then labeled through a join and every segment of a period is aggregated by a single
+    group-by.
+    """
+    if len(segment_keys) == 0:
+        return {}
+
+    df = df.filter(get_filter_expression(filters))
+    dimensions = list(dict.fromkeys(sub_key.dimension for sub_key in flatten(segment_keys)))
+    labels_df = label_waterfall_segments(df.lazy().select(dimensions).unique().collect(), segment_keys)
+
+    baseline_df, comparison_df = pl.collect_all([
+        select_date_range(df, date_range).lazy()
+        .join(labels_df.lazy(), on=dimensions, how="inner")
+        .groupby("waterfall_segment")
+        .agg(build_aggregation_expressions([metric]))
+        for date_range in [baseline_date_range, comparison_date_range]
+    ])
+    baseline_values = dict(zip(baseline_df["waterfall_segment"], baseline_df[metric.get_id()]))
+    comparison_values = dict(zip(comparison_df["waterfall_segment"], comparison_df[metric.get_id()]))
+
+    result = {}
+    for index, segment_key in enumerate(segment_keys):
         serialized_key = "|".join([
             f"{sub_key.dimension}:{sub_key.value}" for sub_key in segment_key
         ])
         result[serialized_key] = {
-            "changeWithNoOverlap": comparison_value - baseline_value
+            "changeWithNoOverlap": comparison_values.get(index, 0) - baseline_values.get(index, 0)
         }
 
-        df = df.filter(filtering_clause.is_not())
-
     return result
 
 
@@ -152,3 +205,33 @@ def map_to_segment_info(row, baseline_count: int, comparison_count: int, metric:
         None,
         None
     )
+
+
+def map_to_segment_info_df(joined: pl.DataFrame, dimensions: list[str], baseline_count: int, comparison_count: int, metric: Metric) -> pl.DataFrame:
+    """The columnar counterpart of map_to_segment_info."""
+    comparison_value = signed_value_expr(joined, metric.get_id())
+    baseline_value = signed_value_expr(joined, f"{metric.get_id()}_baseline")
+
+    return joined.select(
+        pl.concat_list([
+            pl.struct([pl.lit(dimension).alias("dimension"), pl.col("dimension_value").list.get(i).fill_null("None").alias("value")])
+            for i, dimension in enumerate(dimensions)
+        ]).alias("key"),
+        pl.col("serialized_key").alias("serializedKey"),
+        pl.struct([
+            pl.col("count_baseline").alias("sliceCount"),
+            (pl.col("count_baseline") / pl.lit(baseline_count)).alias("sliceSize"),
+            pl.col(f"{metric.get_id()}_baseline").alias("sliceValue")
+        ]).alias("baselineValue"),
+        pl.struct([
+            pl.col("count").alias("sliceCount"),
+            (pl.col("count") / pl.lit(comparison_count)).alias("sliceSize"),
+            pl.col(metric.get_id()).alias("sliceValue")
+        ]).alias("comparisonValue"),
+        (comparison_value - baseline_value).alias("impact"),
+        pl.when(baseline_value == 0).then(pl.lit(1.0)).otherwise((comparison_value - baseline_value) / baseline_value).alias("changePercentage"),
+        pl.lit(None, dtype=pl.Float64).alias("changeDev"),
+        pl.lit(None, dtype=pl.Float64).alias("absoluteContribution"),
+        pl.lit(None, dtype=pl.Float64).alias("confidence"),
+        pl.lit(None, dtype=pl.Float64).alias("sortValue")
+    )
@@ -0,0 +1,67 @@
+import io
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+import polars as pl
+
+# The columns of the segment table which segments can be ranked by, the segments are ranked by their absolute value
+SEGMENT_SORT_COLUMNS = {
+    "sort": "sortValue",
+    "change_variance": "changeDev",
+    "absolute_contribution": "absoluteContribution"
+}
+
+
+@dataclass
+class DimensionFilter:
+    """Keeps the segments containing the dimension, with the given value if there is one."""
+    dimension: str
+    value: Optional[str] = None
+
+
+def limit_segments(segment_info_df: pl.DataFrame, max_num_segments: Optional[int], keys_to_keep: List[str]) -> pl.DataFrame:
+    """Keep the first max_num_segments segments of the table, which is sorted by the sort value, plus the given segments."""
+    if max_num_segments is None:
+        return segment_info_df
+
+    return segment_info_df.filter(
+        (pl.arange(0, pl.count()) < max_num_segments) | pl.col("serializedKey").is_in(keys_to_keep)
+    )
+
+
+def _dimension_filter_expression(dimension_filter: DimensionFilter) -> pl.Expr:
+    key_component_filter = pl.element().struct.field("dimension") == dimension_filter.dimension
+    if dimension_filter.value is not None:
+        key_component_filter = key_component_filter & (pl.element().struct.field("value") == dimension_filter.value)
+    return pl.col("key").list.eval(key_component_filter).list.any()
+
+
+def get_segment_page(
+        segment_info_df: pl.DataFrame,
+        sort_by: str,
+        dimension_filters: List[DimensionFilter],
+        offset: int,
+        page_size: int
+) -> Tuple[pl.DataFrame, int]:
+    """
+    Rank the segments by the sort column and return one page of the segments matching all the dimension filters, along with
+    the number of matching segments. Ties are broken by the segment key so that the pages do not overlap.
+    """
+    if sort_by not in SEGMENT_SORT_COLUMNS:
+        raise ValueError(f"Cannot sort segments by {sort_by}, expected one of {list(SEGMENT_SORT_COLUMNS.keys())}")
+
+    matching_df = segment_info_df.lazy()
+    for dimension_filter in dimension_filters:
+        matching_df = matching_df.filter(_dimension_filter_expression(dimension_filter))
+    matching_df = matching_df \
+        .sort([pl.col(SEGMENT_SORT_COLUMNS[sort_by]).abs(), pl.col("serializedKey")], descending=[True, False]) \
+        .collect()
+
+    return matching_df.slice(offset, page_size), matching_df.height
+
+
+def dump_rows(df: pl.DataFrame) -> bytes:
+    """Serialize the rows into a json array, the rows are written by polars without materializing them as python objects."""
+    buffer = io.BytesIO()
+    df.write_ndjson(buffer)
+    return b"[" + b",".join(buffer.getvalue().splitlines()) + b"]"
@@ -0,0 +1,53 @@
+from typing import List
+
+import polars as pl
+from polars import Expr
+
+from app.insight.services.metrics import AggregateMethod, DualColumnMetric, Metric, SingleColumnMetric, flatten
+
+# Distinct counts are approximated with K minimum values sketches, which keep the smallest hashes of the values. Counts below
+# the sketch size are exact, larger ones have a relative standard error of about 1 / sqrt(DISTINCT_SKETCH_SIZE - 2), 1.6%,
+# and stay within 5% in over 99.9% of the cases. Sketches are merged by keeping the smallest hashes of their union, so the
+# count of any union of segments or days is estimated as accurately as if it was sketched from the rows.
+DISTINCT_SKETCH_SIZE = 4096
+DISTINCT_SKETCH_HASH_SEED = 0
+
+
+def build_distinct_sketch(column: Expr) -> Expr:
+    """Aggregate the values into their sketch."""
+    return column.hash(DISTINCT_SKETCH_HASH_SEED).unique().bottom_k(DISTINCT_SKETCH_SIZE)
+
+
+def merge_distinct_sketches(sketches: Expr) -> Expr:
+    """Aggregate a column of sketches into the sketch of their union, missing sketches are empty."""
+    return sketches.flatten().drop_nulls().unique().bottom_k(DISTINCT_SKETCH_SIZE)
+
+
+def estimate_distinct_count(sketch: Expr) -> Expr:
+    """Aggregate the hashes of a sketch into the distinct count they estimate."""
+    num_hashes = sketch.count()
+    return pl.when(num_hashes < DISTINCT_SKETCH_SIZE) \
+        .then(num_hashes.cast(pl.Float64)) \
+        .otherwise((DISTINCT_SKETCH_SIZE - 1) / (sketch.max().cast(pl.Float64) / 2.0 ** 64))
+
+
+def estimate_distinct_counts(sketches: Expr) -> Expr:
+    """The distinct count estimated by each sketch of a column of sketches."""
+    num_hashes = sketches.list.lengths()
+    return pl.when(num_hashes < DISTINCT_SKETCH_SIZE) \
+        .then(num_hashes.cast(pl.Float64)) \
+        .otherwise((DISTINCT_SKETCH_SIZE - 1) / (sketches.list.max().cast(pl.Float64) / 2.0 ** 64))
+
+
+def get_sketched_metrics(metrics: List[Metric]) -> List[SingleColumnMetric]:
+    """The approximate distinct count metrics, including the numerators and denominators of ratios."""
+    return [
+        metric for metric in flatten([
+            [metric.numerator_metric, metric.denominator_metric] if isinstance(metric, DualColumnMetric) else [metric] for metric in metrics
+        ])
+        if metric.aggregate_method == AggregateMethod.APPROX_DISTINCT
+    ]
+
+
+def get_sketch_column(metric_id: str) -> str:
+    return f"{metric_id}_sketch"
@@ -1,7 +1,16 @@
 import datetime
-from typing import Tuple
+import hashlib
+import io
+import os
+import re
+import threading
+from dataclasses import dataclass
+from typing import Iterator, Optional, Tuple
 
+import orjson
 import polars as pl
+import pyarrow.parquet as pq
+from loguru import logger
 from polars import Expr
 
 from app.insight.services.metrics import Metric, flatten, Filter, FilterOperator
@@ -21,12 +30,7 @@ def build_base_df(
         group_by_columns: list[str],
         metrics: list[Metric]
 ) -> pl.DataFrame:
-    return df.filter(
-        pl.col('date').is_between(
-            pl.lit(date_range[0]),
-            pl.lit(date_range[1])
-        )
-    ).groupby(group_by_columns).agg(build_aggregation_expressions(metrics))
+    return select_date_range(df, date_range).groupby(group_by_columns).agg(build_aggregation_expressions(metrics))
 
 
 def prepare_joined_df(
@@ -61,10 +65,67 @@ def prepare_joined_df(
         .sort(analyzing_metric.get_sorting_expr(), descending=True)
 
 
+def get_date_expression(date_column: str, data_type: pl.PolarsDataType) -> Expr:
+    if data_type == pl.Date:
+        return pl.col(date_column)
+    elif data_type == pl.Datetime:
+        return pl.col(date_column).cast(pl.Date)
+
+    return pl.col(date_column).cast(pl.Utf8).str.slice(0, 10).str.to_date(strict=False)
+
+
+def iter_rows_by_key(df: pl.DataFrame, key_column: str, batch_size: int) -> Iterator[bytes]:
+    """
+    Serialize the rows into a json object keyed by the key column, one chunk per batch of rows. The rows are written by polars
+    without materializing them as python objects.
+    """
+    yield b"{"
+    for offset in range(0, df.height, batch_size):
+        batch_df = df.slice(offset, batch_size)
+        buffer = io.BytesIO()
+        batch_df.write_ndjson(buffer)
+
+        keys = batch_df[key_column].to_list()
+        rows = buffer.getvalue().splitlines()
+        yield (b"," if offset > 0 else b"") + b",".join([orjson.dumps(key) + b":" + row for key, row in zip(keys, rows)])
+    yield b"}"
+
+
+NULL_DIMENSION_CODE = 2 ** 32 - 1
+
+
+def encode_dimension_columns(df: pl.DataFrame, columns: list[str]) -> Tuple[pl.DataFrame, pl.DataFrame]:
+    """
+    Replace the dimension columns by integer codes of their string values, so that the group-bys, joins and filters of the
+    segment analysis run on integers. Empty values get a code as well so that they can be joined on. Returns the encoded
+    frame and the dictionary with the dimension_name, code and value of every dimension value.
+    """
+    values_df = df.select([pl.col(column).cast(pl.Utf8) for column in columns])
+    codes_df = values_df.select([
+        pl.when(pl.col(column).is_null()).then(pl.lit(NULL_DIMENSION_CODE, dtype=pl.UInt32)).otherwise(
+            pl.col(column).cast(pl.Categorical).to_physical()
+        ).alias(column)
+        for column in columns
+    ])
+    dictionary_df = pl.concat([
+        pl.DataFrame({"code": codes_df[column], "value": values_df[column]})
+        .unique(subset="code")
+        .select(pl.lit(column).alias("dimension_name"), pl.col("code"), pl.col("value"))
+        for column in columns
+    ])
+
+    return df.with_columns(codes_df), dictionary_df
+
+
 def get_num_rows(df: pl.DataFrame) -> int:
     return df.select(pl.count()).item(0, 0)
 
 
+def signed_value_expr(df: pl.DataFrame, column: str) -> Expr:
+    """The column as a signed value, counts are aggregated as unsigned integers which would wrap around on negative impacts."""
+    return pl.col(column).cast(pl.Int64) if df.schema[column] in pl.INTEGER_DTYPES else pl.col(column)
+
+
 def get_filter_expression(filters: list[Filter]) -> Expr:
     filter_expr = pl.lit(True)
 
@@ -84,20 +145,199 @@ def get_filter_expression(filters: list[Filter]) -> Expr:
     return filter_expr
 
 
-def load_df_from_csv(path: str, date_column: str = None):
-    df = pl.read_csv(path, try_parse_dates=True)
-    for column_and_d_type in zip(df.columns, df.dtypes):
-        [column, d_type] = column_and_d_type
-        if date_column is not None and column != date_column:
+# Number of values of a column the date format is inferred from
+DATE_INFERENCE_SAMPLE_SIZE = 1000
+
+ISO_DATETIME_PATTERN = r"^\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}"
+
+# Formats tried in order, the first one parsing every sampled value is used. Month first formats come before day first ones,
+# and two digit years before four digit ones since %Y would read 23 as the year 23. A missing format means polars infers
+# the ISO 8601 variant, which only applies to the columns matching ISO_DATETIME_PATTERN.
+DATE_FORMATS: list[Tuple[pl.PolarsDataType, Optional[str]]] = [
+    (pl.Date, "%Y-%m-%d"),
+    (pl.Datetime, None),
+] + [
+    (pl.Date, f"{day_and_month}/{year}") for day_and_month in ["%m/%d", "%d/%m"] for year in ["%y", "%Y"]
+] + [
+    (pl.Datetime, f"{day_and_month}/{year} {time}")
+    for day_and_month in ["%m/%d", "%d/%m"] for year in ["%y", "%Y"] for time in ["%H:%M", "%H:%M:%S"]
+]
+
+EPOCH_COLUMN_NAME_PATTERN = re.compile(r"date|time|day|epoch|(^|_)ts(_|$)|_at$", re.IGNORECASE)
+
+# Integers above these are taken as micro and milliseconds since the epoch, like in BqMetrics
+EPOCH_MILLIS_MIN_VALUE = 1924991999
+EPOCH_MICROS_MIN_VALUE = 1924991999999
+# Seconds since the epoch before 2001 are more likely to be something else than dates
+EPOCH_SECONDS_MIN_VALUE = 10 ** 9
+
+
+def parse_date_column(series: pl.Series, date_format: Tuple[pl.PolarsDataType, Optional[str]]) -> pl.Series:
+    data_type, pattern = date_format
+    return series.str.strptime(data_type, pattern, strict=False)
+
+
+def infer_date_format(series: pl.Series) -> Optional[Tuple[pl.PolarsDataType, Optional[str]]]:
+    """The first of the date formats which parses all of the sampled non empty values of the string column, if any."""
+    sample = series.filter(series.is_not_null() & (series.str.lengths() > 0)).head(DATE_INFERENCE_SAMPLE_SIZE)
+    if sample.len() == 0:
+        return None
+
+    is_iso_datetime = sample.str.contains(ISO_DATETIME_PATTERN).all()
+    for date_format in DATE_FORMATS:
+        if date_format[1] is None and not is_iso_datetime:
             continue
+        if parse_date_column(sample, date_format).null_count() == 0:
+            return date_format
+    return None
+
+
+def infer_epoch_time_unit(series: pl.Series) -> Optional[str]:
+    """The time unit of an integer column holding epoch timestamps, only considered for columns named like a date."""
+    if not EPOCH_COLUMN_NAME_PATTERN.search(series.name) or series.null_count() == series.len():
+        return None
+
+    min_value, max_value = series.min(), series.max()
+    if min_value < EPOCH_SECONDS_MIN_VALUE:
+        return None
+    if max_value > EPOCH_MICROS_MIN_VALUE:
+        return "us" if min_value > EPOCH_MICROS_MIN_VALUE else None
+    if max_value > EPOCH_MILLIS_MIN_VALUE:
+        return "ms" if min_value > EPOCH_MILLIS_MIN_VALUE else None
+    return "s"
+
+
+def parse_date_columns(df: pl.DataFrame) -> pl.DataFrame:
+    """
+    Convert the columns holding dates to date or datetime columns. The format of every string column is inferred once from
+    a sample of its values and the whole column is then parsed with it, a column is left as is if any of its values does
+    not match the format. Integer columns named like a date and holding epoch timestamps are converted as well.
+    """
+    parsed_columns = []
+    for column, data_type in zip(df.columns, df.dtypes):
+        series = df[column]
+        if data_type == pl.Utf8:
+            date_format = infer_date_format(series)
+            if date_format is None:
+                continue
+
+            parsed_series = parse_date_column(series, date_format)
+            num_empty_values = series.filter(series.is_null() | (series.str.lengths() == 0)).len()
+            if parsed_series.null_count() == num_empty_values:
+                logger.info(f"Parsed column {column} as {date_format[0]} with format {date_format[1]}")
+                parsed_columns.append(parsed_series)
+        elif data_type in pl.INTEGER_DTYPES:
+            time_unit = infer_epoch_time_unit(series)
+            if time_unit is not None:
+                logger.info(f"Parsed column {column} as epoch timestamps in {time_unit}")
+                parsed_columns.append(pl.from_epoch(series, time_unit=time_unit).alias(column))
+
+    return df.with_columns(parsed_columns)
+
+
+def load_df_from_csv(path: str) -> pl.DataFrame:
+    return parse_date_columns(pl.read_csv(path))
 
-        if d_type == pl.Utf8:
-            non_null_count = df.filter(pl.col(column).str.lengths().gt(0) & pl.col(column).is_not_null()).select(pl.col(column).count()).row(0)[0]
-            if non_null_count > 0:
-                try:
-                    df = df.with_columns(
-                        pl.col(column).str.to_date("%-m/%-d/%y %k:%M").alias(column)
-                    )
-                except:
-                    pass
-    return df
+
+# Bump when the parsing of the uploaded files changes, so that the files are parsed again
+PARQUET_SIDECAR_VERSION = 1
+
+
+def get_parquet_path(path: str) -> str:
+    return f"{path}.v{PARQUET_SIDECAR_VERSION}.parquet"
+
+
+def write_parquet_atomically(df: pl.DataFrame, parquet_path: str, row_group_size: Optional[int] = None, use_pyarrow: bool = False):
+    temp_parquet_path = f"{parquet_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    df.write_parquet(temp_parquet_path, compression="zstd", statistics=True, row_group_size=row_group_size, use_pyarrow=use_pyarrow)
+    os.replace(temp_parquet_path, parquet_path)
+
+
+def save_df_as_parquet(df: pl.DataFrame, path: str):
+    """Persist the parsed file as a typed, column-compressed parquet sidecar next to the uploaded file."""
+    write_parquet_atomically(df, get_parquet_path(path))
+
+
+def load_df_from_file(path: str, columns: Optional[list[str]] = None) -> pl.DataFrame:
+    """Load an uploaded file, only parsing the csv if its parquet sidecar has not been written yet."""
+    if os.path.exists(get_parquet_path(path)):
+        return pl.read_parquet(get_parquet_path(path), columns=columns)
+
+    df = load_df_from_csv(path)
+    save_df_as_parquet(df, path)
+    return df if columns is None else df.select(columns)
+
+
+# Rows per row group of the date sorted sidecars, which is the granularity reads of a date range skip rows with
+DATE_SORTED_ROW_GROUP_SIZE = 65536
+
+
+def get_date_sorted_parquet_path(path: str, date_column: str) -> str:
+    return f"{path}.v{PARQUET_SIDECAR_VERSION}.by-date-{hashlib.md5(date_column.encode()).hexdigest()}.parquet"
+
+
+def save_df_sorted_by_date(path: str, date_column: str):
+    """
+    Persist the rows of the uploaded file sorted by the date of the date column, along with that date as the date column.
+    Rows without a date are left out since they fall outside of every date range. It is written by pyarrow, which unlike
+    polars stores the min and max of the dates of every row group, so that reads of a date range only decode the row groups
+    overlapping with it.
+    """
+    df = load_df_from_file(path)
+    df = df.with_columns(get_date_expression(date_column, df.schema[date_column]).alias("date")) \
+        .filter(pl.col("date").is_not_null()) \
+        .sort("date")
+
+    write_parquet_atomically(df, get_date_sorted_parquet_path(path, date_column), DATE_SORTED_ROW_GROUP_SIZE, use_pyarrow=True)
+
+
+@dataclass
+class DateSortedFile:
+    """The columns and the date of an upload in its date sorted sidecar, for frames only read for a few date ranges."""
+    path: str
+    columns: list[str]
+
+    def lazy(self) -> pl.LazyFrame:
+        return pl.scan_parquet(self.path).select(self.columns)
+
+    def read_date_range(self, date_range: Tuple[datetime.date, datetime.date]) -> pl.DataFrame:
+        table = pq.read_table(self.path, columns=self.columns, filters=[("date", ">=", date_range[0]), ("date", "<=", date_range[1])])
+        return pl.from_arrow(table).with_columns(pl.col("date").set_sorted())
+
+
+def get_date_sorted_file(path: str, date_column: str, columns: list[str]) -> DateSortedFile:
+    sorted_path = get_date_sorted_parquet_path(path, date_column)
+    if not os.path.exists(sorted_path):
+        save_df_sorted_by_date(path, date_column)
+    return DateSortedFile(sorted_path, list(dict.fromkeys(columns + ["date"])))
+
+
+def load_df_with_date(path: str, date_column: str, columns: list[str]) -> pl.DataFrame:
+    """Load the columns and the date from the date sorted sidecar, flagging the date as sorted for select_date_range."""
+    date_sorted_file = get_date_sorted_file(path, date_column, columns)
+    return pl.read_parquet(date_sorted_file.path, columns=date_sorted_file.columns).with_columns(pl.col("date").set_sorted())
+
+
+def select_date_range(
+        df: pl.DataFrame | pl.LazyFrame | DateSortedFile,
+        date_range: Tuple[datetime.date, datetime.date]
+) -> pl.DataFrame | pl.LazyFrame:
+    """
+    The rows within the date range. Frames whose date is flagged as sorted are sliced at the bounds found by a binary search
+    on the date, instead of comparing the date of every row, and date sorted files only read the row groups of the range.
+    """
+    if isinstance(df, DateSortedFile):
+        return df.read_date_range(date_range)
+
+    if isinstance(df, pl.DataFrame) and df["date"].flags["SORTED_ASC"] and df["date"].null_count() == 0:
+        start = df["date"].search_sorted(pl.Series([date_range[0]]), side="left")[0]
+        end = df["date"].search_sorted(pl.Series([date_range[1]]), side="right")[0]
+        return df.slice(start, max(end - start, 0))
+
+    return df.filter(
+        pl.col('date').is_between(
+            pl.lit(date_range[0]),
+            pl.lit(date_range[1])
+        )
+    )
@@ -5,6 +5,16 @@ class ConfigKey(Enum):
     TEMP_FILE_PATH = "TEMP_FILE_PATH"
     ENABLE_TELEMETRY = "ENABLE_TELEMETRY"
     SHOW_DEBUG_INFO = "SHOW_DEBUG_INFO"
+    DATAFRAME_CACHE_SIZE_MB = "DATAFRAME_CACHE_SIZE_MB"
+    RESULT_CACHE_MEMORY_SIZE_MB = "RESULT_CACHE_MEMORY_SIZE_MB"
+    RESULT_CACHE_DISK_SIZE_MB = "RESULT_CACHE_DISK_SIZE_MB"
+    SEGMENT_TABLE_CACHE_SIZE_MB = "SEGMENT_TABLE_CACHE_SIZE_MB"
+    DAILY_CUBE_CACHE_SIZE_MB = "DAILY_CUBE_CACHE_SIZE_MB"
+    SCHEMA_APPROX_DISTINCT_MIN_ROWS = "SCHEMA_APPROX_DISTINCT_MIN_ROWS"
+    ANALYSIS_EXECUTOR = "ANALYSIS_EXECUTOR"
+    ANALYSIS_MAX_WORKERS = "ANALYSIS_MAX_WORKERS"
+    INSIGHT_JOB_MAX_WORKERS = "INSIGHT_JOB_MAX_WORKERS"
+    INSIGHT_JOB_HISTORY_SIZE = "INSIGHT_JOB_HISTORY_SIZE"
 
     ENABLE_BIGQUERY_INTEGRATION = "ENABLE_BIGQUERY_INTEGRATION"
 
@@ -14,6 +24,19 @@ class CommonConfig:
 
     FAB_ADD_SECURITY_VIEWS = False
     TEMP_FILE_PATH = "/tmp/dsensei"
+    DATAFRAME_CACHE_SIZE_MB = 2048
+    RESULT_CACHE_MEMORY_SIZE_MB = 256
+    RESULT_CACHE_DISK_SIZE_MB = 2048
+    SEGMENT_TABLE_CACHE_SIZE_MB = 512
+    DAILY_CUBE_CACHE_SIZE_MB = 512
+    # Files with at least this many rows get approximate distinct value counts in their schema
+    SCHEMA_APPROX_DISTINCT_MIN_ROWS = 1000000
+    # One of thread, process or sequential, the worker count defaults to the number of cores
+    ANALYSIS_EXECUTOR = "thread"
+    ANALYSIS_MAX_WORKERS = None
+    # Insight jobs running at once, further jobs wait in a queue. The state of this many most recent jobs is kept for polling.
+    INSIGHT_JOB_MAX_WORKERS = 2
+    INSIGHT_JOB_HISTORY_SIZE = 100
 
 
 class DevConfig(CommonConfig):
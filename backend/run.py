@@ -1,4 +1,4 @@
 from app import app
 
 if __name__ == '__main__':
-    app.run(debug=True, port=5001, host="::", threaded=False, processes=4)
+    app.run(debug=True, port=5001, host="::", threaded=True)
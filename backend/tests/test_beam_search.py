@@ -0,0 +1,74 @@
+import datetime
+
+import numpy as np
+import orjson
+import polars
+import pytest
+
+from app.insight.services.analysis_executor import AnalysisExecutor, AnalysisExecutorType
+from app.insight.services.insight_builders import BeamSearchOptions, DFBasedInsightBuilder
+from app.insight.services.metrics import AggregateMethod, SingleColumnMetric
+
+BASELINE_DATE_RANGE = (datetime.date(2023, 1, 1), datetime.date(2023, 1, 10))
+COMPARISON_DATE_RANGE = (datetime.date(2023, 1, 11), datetime.date(2023, 1, 20))
+GROUP_BY_COLUMNS = ["country", "device", "channel", "plan", "user_id"]
+
+
+@pytest.fixture
+def df() -> polars.DataFrame:
+    # The user ids make every combination with them wide, enough to fill the segment budget with four dimensions alone
+    rng = np.random.default_rng(0)
+    num_rows = 30000
+    return polars.DataFrame({
+        "country": rng.integers(0, 5, num_rows).astype(str),
+        "device": rng.integers(0, 3, num_rows).astype(str),
+        "channel": rng.integers(0, 4, num_rows).astype(str),
+        "plan": rng.integers(0, 3, num_rows).astype(str),
+        "user_id": rng.integers(0, 3000, num_rows).astype(str),
+        "date": [datetime.date(2023, 1, 1) + datetime.timedelta(days=int(day)) for day in rng.integers(0, 20, num_rows)],
+        "value": rng.random(num_rows)
+    }).sort("date")
+
+
+def build_insight(df: polars.DataFrame, max_num_dimensions: int, beam_search_options: BeamSearchOptions = None) -> dict:
+    builder = DFBasedInsightBuilder(
+        df,
+        BASELINE_DATE_RANGE,
+        COMPARISON_DATE_RANGE,
+        GROUP_BY_COLUMNS,
+        [SingleColumnMetric(None, "value", AggregateMethod.SUM, [])],
+        0,
+        [],
+        max_num_dimensions,
+        AnalysisExecutor(AnalysisExecutorType.SEQUENTIAL),
+        beam_search_options=beam_search_options
+    )
+    return orjson.loads(builder.build())["value_SUM"]
+
+
+def count_segments_by_num_dimensions(insight: dict) -> dict[int, int]:
+    counts = {}
+    for segment in insight["dimensionSliceInfo"].values():
+        counts[len(segment["key"])] = counts.get(len(segment["key"]), 0) + 1
+    return counts
+
+
+def test_segment_budget_leaves_room_for_the_last_level(df):
+    counts = count_segments_by_num_dimensions(build_insight(df, 5))
+
+    assert counts.get(4, 0) > 0
+    assert counts.get(5, 0) > 0
+
+
+def test_truncated_level_keeps_the_largest_contributions(df):
+    options = BeamSearchOptions(max_segments=10)
+    full_level = build_insight(df, 4)
+    truncated_level = build_insight(df, 4, options)
+
+    def four_dimension_contributions(insight: dict) -> list[float]:
+        return sorted(
+            (abs(segment["absoluteContribution"]) for segment in insight["dimensionSliceInfo"].values() if len(segment["key"]) == 4),
+            reverse=True
+        )
+
+    assert four_dimension_contributions(truncated_level) == pytest.approx(four_dimension_contributions(full_level)[:options.max_segments])
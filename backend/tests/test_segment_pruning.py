@@ -0,0 +1,53 @@
+import datetime
+
+import numpy as np
+import orjson
+import polars
+import pytest
+
+from app.insight.services.analysis_executor import AnalysisExecutor, AnalysisExecutorType
+from app.insight.services.insight_builders import DFBasedInsightBuilder
+from app.insight.services.metrics import AggregateMethod, SingleColumnMetric
+
+BASELINE_DATE_RANGE = (datetime.date(2023, 1, 1), datetime.date(2023, 1, 10))
+COMPARISON_DATE_RANGE = (datetime.date(2023, 1, 11), datetime.date(2023, 1, 20))
+
+
+@pytest.fixture
+def df() -> polars.DataFrame:
+    # Two dimensions with many values so that pruning by support empties most of the combinations
+    rng = np.random.default_rng(0)
+    num_rows = 5000
+    return polars.DataFrame({
+        "a": rng.integers(0, 50, num_rows).astype(str),
+        "b": rng.integers(0, 50, num_rows).astype(str),
+        "c": rng.integers(0, 3, num_rows).astype(str),
+        "date": [datetime.date(2023, 1, 1) + datetime.timedelta(days=int(day)) for day in rng.integers(0, 20, num_rows)],
+        "value": rng.random(num_rows)
+    }).sort("date")
+
+
+def build_insight(df: polars.DataFrame, executor_type: AnalysisExecutorType, tmp_path) -> dict:
+    builder = DFBasedInsightBuilder(
+        df,
+        BASELINE_DATE_RANGE,
+        COMPARISON_DATE_RANGE,
+        ["a", "b", "c"],
+        [SingleColumnMetric(None, "value", AggregateMethod.SUM, [])],
+        0,
+        [],
+        3,
+        AnalysisExecutor(executor_type, 2, str(tmp_path)),
+        min_segment_support=0.05
+    )
+    return orjson.loads(builder.build())["value_SUM"]
+
+
+@pytest.mark.parametrize("executor_type", [AnalysisExecutorType.THREAD, AnalysisExecutorType.PROCESS])
+def test_pruned_segments_match_sequential_analysis(df, executor_type, tmp_path):
+    expected = build_insight(df, AnalysisExecutorType.SEQUENTIAL, tmp_path)
+    actual = build_insight(df, executor_type, tmp_path)
+
+    assert actual["totalSegments"] == expected["totalSegments"]
+    assert actual["topDriverSliceKeys"] == expected["topDriverSliceKeys"]
+    assert actual["dimensionSliceInfo"].keys() == expected["dimensionSliceInfo"].keys()
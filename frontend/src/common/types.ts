@@ -26,6 +26,8 @@ export interface InsightMetric {
   dimensionSliceInfo: {
     [key: string]: DimensionSliceInfo;
   };
+  isSampled?: boolean;
+  samplingFraction?: number;
 }
 
 export interface Dimension {
@@ -58,6 +60,9 @@ export interface DimensionSliceInfo {
   impact: number;
   changePercentage: number;
   changeDev: number;
+  // 95% confidence intervals of insights estimated from a sample of the rows
+  changePercentageInterval?: [number, number];
+  absoluteContributionInterval?: [number, number];
   confidence: number;
   sortValue: number;
 }
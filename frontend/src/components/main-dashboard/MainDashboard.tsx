@@ -533,6 +533,7 @@ export default function MainDashboard() {
               metricName={formatMetricName(analyzingMetrics)}
               aggregationMethod={analyzingMetrics.aggregationMethod}
               targetDirection={targetDirection}
+              isSampled={analyzingMetrics.isSampled}
             />
             <Card className="col-span-4">
               <Title>Day by Day Value</Title>
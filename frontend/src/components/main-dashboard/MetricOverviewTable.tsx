@@ -35,6 +35,7 @@ interface Props {
   }[];
   metricName: string;
   targetDirection: TargetDirection;
+  isSampled?: boolean;
 }
 
 function getChangePercentageBadge(
@@ -92,6 +93,7 @@ export function MetricOverviewTable({
   metricName,
   targetDirection,
   aggregationMethod,
+  isSampled,
 }: Props) {
   return (
     <Card className="overflow-overlay">
@@ -101,7 +103,14 @@ export function MetricOverviewTable({
             <TableHeaderCell></TableHeaderCell>
             <TableHeaderCell>Period</TableHeaderCell>
             <TableHeaderCell>Rows</TableHeaderCell>
-            <TableHeaderCell>{metricName}</TableHeaderCell>
+            <TableHeaderCell>
+              {metricName}
+              {isSampled && (
+                <Badge color="amber" size="xs" className="ml-2">
+                  Approximate
+                </Badge>
+              )}
+            </TableHeaderCell>
             {supportingMetrics.map((metric) => (
               <TableHeaderCell>{metric.name}</TableHeaderCell>
             ))}
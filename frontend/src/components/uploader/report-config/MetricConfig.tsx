@@ -103,8 +103,8 @@ const MetricConfig = (props: Props) => {
               Select the numerator metric type
             </Text>
           }
-          labels={["Sum", "Count", "Distinct"]}
-          values={["sum", "count", "nunique"]}
+          labels={["Sum", "Count", "Distinct", "Approx. Distinct"]}
+          values={["sum", "count", "nunique", "approx_nunique"]}
           selectedValue={ratioMetric?.numerator?.aggregationMethod || ""}
           onValueChange={(metric) => {
             setMetricColumn({
@@ -182,8 +182,8 @@ const MetricConfig = (props: Props) => {
               Select the denominator metric type
             </Text>
           }
-          labels={["Sum", "Count", "Distinct"]}
-          values={["sum", "count", "nunique"]}
+          labels={["Sum", "Count", "Distinct", "Approx. Distinct"]}
+          values={["sum", "count", "nunique", "approx_nunique"]}
           selectedValue={ratioMetric?.denominator?.aggregationMethod || ""}
           onValueChange={(metric) => {
             setMetricColumn({
@@ -262,8 +262,8 @@ const MetricConfig = (props: Props) => {
     <>
       <SingleSelector
         title={<Text className="pr-4 text-black">Select the metric type</Text>}
-        labels={["Sum", "Count", "Distinct", "Ratio"]}
-        values={["sum", "count", "nunique", "ratio"]}
+        labels={["Sum", "Count", "Distinct", "Approx. Distinct", "Ratio"]}
+        values={["sum", "count", "nunique", "approx_nunique", "ratio"]}
         selectedValue={metricType ? metricType : ""}
         onValueChange={(metric) => {
           setMetricColumn({
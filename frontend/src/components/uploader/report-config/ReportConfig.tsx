@@ -69,6 +69,11 @@ function ReportConfig({
   const [metricColumn, setMetricColumn] = useState<MetricColumn>();
   const [expectedValue, setExpectedValue] = useState<number>();
   const [maxNumDimensions, setMaxNumDimensions] = useState<number>(3);
+  // BigQuery reports only group by up to three dimensions
+  const maxNumDimensionsOptions =
+    dataSourceType === "bigquery"
+      ? ["1", "2", "3"]
+      : ["1", "2", "3", "4", "5"];
   const [filters, setFilters] = useState<Filter[]>([]);
 
   const debugMode = getServerData().settings.showDebugInfo;
@@ -378,8 +383,8 @@ function ReportConfig({
                     Max number of dimensions
                   </Text>
                 }
-                labels={["1", "2", "3"]}
-                values={["1", "2", "3"]}
+                labels={maxNumDimensionsOptions}
+                values={maxNumDimensionsOptions}
                 selectedValue={maxNumDimensions.toString()}
                 onValueChange={(value) => setMaxNumDimensions(parseInt(value))}
                 instruction={
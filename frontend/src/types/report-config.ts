@@ -4,7 +4,7 @@ import { DateRangeData } from "../components/uploader/DatePicker";
 import { FieldType } from "./data-source";
 
 export type ColumnType = "metric" | "supporting_metric" | "dimension" | "date";
-export type AggregationType = "sum" | "count" | "nunique" | "ratio";
+export type AggregationType = "sum" | "count" | "nunique" | "approx_nunique" | "ratio";
 export type TargetDirection = "increasing" | "decreasing";
 
 export interface SingularMetric {